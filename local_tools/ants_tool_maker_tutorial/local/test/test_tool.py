@@ -6,7 +6,7 @@ from qmenta.sdk.tool_maker.context import TestFileInput
 from qmenta.sdk.tool_maker.modalities import Modality, Tag
 import sys
 sys.path.append("local_tools")
-from ants_tool_maker_tutorial.tool import QmentaSDKToolMakerTutorial
+from ants_tool_maker_tutorial.tool import QmentaSDKToolMakerTutorial, parse_mrf_values
 
 
 class TestTool(unittest.TestCase):
@@ -49,6 +49,24 @@ class TestTool(unittest.TestCase):
         )
 
 
+class TestParseMrfValues(unittest.TestCase):
+    """Tests for the parsing of the 'mrf' setting, which do not need ANTs.
+    $ pytest local_tools/ants_tool_maker_tutorial/local/test/test_tool.py::TestParseMrfValues
+    """
+
+    def test_values(self):
+        self.assertEqual(parse_mrf_values("[0.2, 1x1]"), ["[0.2, 1x1]"])
+        self.assertEqual(parse_mrf_values("[0.2, 1x1] [0.3, 1x1]; [0.2, 1x1]"), ["[0.2, 1x1]", "[0.3, 1x1]"])
+        self.assertEqual(parse_mrf_values("0.2; 0.3 ;"), ["0.2", "0.3"])
+        # Same suffix, hence the same output file names
+        self.assertEqual(parse_mrf_values("[0.2, 1x1]; [0.3, 1x1]; [0.3,1x1]"), ["[0.2, 1x1]", "[0.3, 1x1]"])
+
+    def test_invalid_values(self):
+        for value in ("", " ; ", "[0.2, 1x1]; 0.5", "0.5 [0.2, 1x1]"):
+            with self.assertRaises(ValueError, msg=value):
+                parse_mrf_values(value)
+
+
 class TestToolDocker(unittest.TestCase):
     """
     Once the previous test is executed successfully, this test can be run using a docker container.
@@ -1,21 +1,29 @@
 
 import logging
+import multiprocessing
 import os
-import ants
-
-from qmenta.sdk.tool_maker.outputs import (
-    Coloring,
-    HtmlInject,
-    OrientationLayout,
-    PapayaViewer,
-    Region,
-    ResultsConfiguration,
-    Split,
-    Tab,
-)
+import pickle
+import re
+import shutil
+import sys
+import time
+
 from qmenta.sdk.tool_maker.modalities import Modality, Tag
 from qmenta.sdk.tool_maker.tool_maker import InputFile, Tool, FilterFile
 
+# Modules shared with the pyradiomics tool. They are copied next to tool.py in the Docker image, local runs import
+# them from the shared folder of the repository
+SHARED_MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "shared")
+SHARED_MODULES = ("input_cache.py", "upload_manager.py")
+
+try:
+    from input_cache import CachedDownloads
+    from upload_manager import UploadManager
+except ImportError:
+    sys.path.insert(0, os.path.abspath(SHARED_MODULES_DIR))
+    from input_cache import CachedDownloads
+    from upload_manager import UploadManager
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -35,6 +43,137 @@ BODY_TEMPLATE ="""
 <img src="{src_image}" alt="{image_description}" style="max-width: 400px;">
 """
 
+class BrainCrop:
+    """
+    Padded bounding box of the brain mask, used to run the ANTs steps on the brain instead of the whole field of view.
+
+    Inputs are cropped to the box, and results are pasted back into an empty image with the grid, header and affine of
+    the full image. Without a mask (or with an empty one) images are passed through unchanged.
+    """
+
+    def __init__(self, img, mask=None, padding=10):
+        import numpy as np
+
+        self.box = None
+        self.full_voxels = self.voxels = int(np.prod(img.shape))
+        if mask is None:
+            return
+        indices = np.nonzero(mask.numpy())
+        if not len(indices[0]):
+            logging.getLogger("main").warning("Empty brain mask, running on the whole field of view")
+            return
+
+        box = np.zeros(img.shape, dtype="float32")
+        region = tuple(
+            slice(max(int(axis.min()) - padding, 0), min(int(axis.max()) + padding + 1, dim))
+            for axis, dim in zip(indices, img.shape)
+        )
+        box[region] = 1
+        self.box = img.new_image_like(box)
+        self.background = img.new_image_like(np.zeros(img.shape, dtype="float32"))
+        self.voxels = int(np.prod([axis.stop - axis.start for axis in region]))
+
+    def crop(self, image):
+        """Crop an image in the grid of the full image to the padded bounding box."""
+        if self.box is None:
+            return image
+        import ants
+
+        return ants.crop_image(image, self.box, 1)
+
+    def paste(self, image):
+        """Paste a cropped result into the grid of the full image, with zeros outside the box."""
+        if self.box is None:
+            return image
+        import ants
+
+        return ants.decrop_image(image, self.background)
+
+
+def mrf_suffix(mrf):
+    """File name suffix of the segmentation variant of an Atropos MRF value, e.g. "_mrf-0.2_1x1" for "[0.2, 1x1]"."""
+    return "_mrf-" + re.sub(r"[^0-9A-Za-z.]+", "_", mrf).strip("_")
+
+
+def parse_mrf_values(value):
+    """
+    Atropos MRF parameters of each segmentation variant. Several values can be given, e.g. "[0.2, 1x1] [0.3, 1x1]"
+    or "[0.2, 1x1]; [0.3, 1x1]"; values are returned in the order given, without duplicates. Values that only differ
+    in spacing or punctuation, e.g. "[0.3, 1x1]" and "[0.3,1x1]", are duplicates: they would share the file names of
+    their variant.
+
+    Values are either all bracketed or all plain (separated by semicolons). Mixing both, as in "[0.2, 1x1]; 0.5",
+    raises a ValueError instead of dropping the plain values.
+    """
+    values = re.findall(r"\[[^\]]*\]", value)
+    if values:
+        unbracketed = re.sub(r"\[[^\]]*\]", "", value)
+        if unbracketed.strip(" ;,\t\n"):
+            raise ValueError("'mrf' values must either all be bracketed or all be plain, got {!r}".format(value))
+    else:
+        values = value.split(";")
+    variants = []
+    suffixes = set()
+    for mrf in values:
+        mrf = mrf.strip()
+        if mrf and mrf_suffix(mrf) not in suffixes:
+            variants.append(mrf)
+            suffixes.add(mrf_suffix(mrf))
+    if not variants:
+        raise ValueError("At least one 'mrf' value is needed, got {!r}".format(value))
+    return variants
+
+
+# Cropped image, brain mask and crop shared by the segmentation variants of a worker, set by _init_segmentation
+_segmentation_inputs = None
+
+
+def _init_segmentation(inputs, threads=0):
+    """
+    Set the cropped image, brain mask and crop shared by the segmentation variants of a process.
+
+    In worker processes ``inputs`` is pickled and ``threads`` caps the ITK threads of the worker. ITK fixes its thread
+    count when a process creates its first image, so the images are only unpickled once the cap is set.
+    """
+    global _segmentation_inputs
+    if threads:
+        os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads)
+    _segmentation_inputs = pickle.loads(inputs) if isinstance(inputs, bytes) else inputs
+
+
+def run_segmentation_variant(mrf, suffix, do_thickness):
+    """
+    Run Atropos with one MRF value, and optionally Kelly-Kapowski on its segmentation, on the shared inputs.
+
+    The results are pasted back into the grid of the input image and written to the working directory, named after
+    the suffix of the variant (e.g. "atropos_mrf-0.2_1x1_processed.nii.gz").
+
+    Returns
+    -------
+    dict
+        MRF value, paths of the segmentation and thickness images (None if not computed) and wall time in seconds.
+    """
+    import ants
+
+    img, mask, crop = _segmentation_inputs
+    start = time.time()
+    img_seg = ants.atropos(a=img, m=mrf, c='[2,0]', i='kmeans[3]', x=mask)
+    result = {"mrf": mrf, "segmentation": "atropos{}_processed.nii.gz".format(suffix), "thickness": None}
+    crop.paste(img_seg["segmentation"]).to_filename(result["segmentation"])
+
+    if do_thickness:
+        thickimg = ants.kelly_kapowski(
+            s=img_seg["segmentation"],
+            g=img_seg["probabilityimages"][1],
+            w=img_seg["probabilityimages"][2],
+            its=45, r=0.5, m=1
+        )
+        result["thickness"] = "thickness{}_processed.nii.gz".format(suffix)
+        crop.paste(thickimg).to_filename(result["thickness"])
+
+    result["wall_time"] = time.time() - start
+    return result
+
 
 class QmentaSDKToolMakerTutorial(Tool):
     def tool_inputs(self):
@@ -108,9 +247,52 @@ class QmentaSDKToolMakerTutorial(Tool):
             default="[0.2, 1x1]",  # antspy tutorial uses 2D image
             title="'mrf' parameters as a string, usually \"[smoothingFactor,radius]\" " \
             "where smoothingFactor determines the amount of smoothing and radius determines " \
-            "the MRF neighborhood, as an ANTs style neighborhood vector eg \"1x1\" for a 2D image.", 
+            "the MRF neighborhood, as an ANTs style neighborhood vector eg \"1x1\" for a 2D image. " \
+            "Several values separated by semicolons (eg \"[0.2, 1x1]; [0.3, 1x1]\") run one segmentation " \
+            "(and cortical thickness) per value, in parallel. The viewer shows the results of the first value.", 
+        )
+
+        # Displays an horizontal line
+        self.add_line()
+
+        self.add_input_checkbox(
+            id_="crop_to_brain",
+            default=0,
+            title="Run every step on the bounding box of the brain mask only, instead of the whole field of view. " \
+            "Results are pasted back into the grid of the input image, with zeros outside the box.",
         )
 
+        self.add_input_integer(
+            id_="crop_padding",
+            default=10,
+            title="Padding around the brain bounding box (voxels). Only relevant if cropping to the brain.",
+            minimum=0,
+            maximum=1000,
+        )
+
+    def prepare_inputs(self, context, logger):
+        """
+        Download the data and set the input variables of the tool.
+
+        Tool.prepare_inputs decides where every input file goes, the downloads it starts are served from the node
+        input cache when possible and run concurrently.
+        """
+        with CachedDownloads(context) as downloads:
+            super().prepare_inputs(context, logger)
+
+        for inp in self._inputs:
+            if getattr(inp, "id", None) in downloads.errors:
+                logger.error("Could not download input: {}".format(downloads.errors[inp.id]))
+                if inp.mandatory:
+                    raise downloads.errors[inp.id]
+                setattr(self.inputs, inp.id, None)
+
+    def test_docker_with_args(self, *args, **kwargs):
+        """Same as Tool.test_docker_with_args, with the shared modules copied into the Docker build context."""
+        for module in SHARED_MODULES:
+            shutil.copy(os.path.join(SHARED_MODULES_DIR, module), os.path.join(self.tool_path, "local"))
+        return super().test_docker_with_args(*args, **kwargs)
+
     def run(self, context):
         """
         Main entry point for the tool execution.
@@ -156,12 +338,29 @@ class QmentaSDKToolMakerTutorial(Tool):
         logger.info("Starting processing phase")
         logger.info("Selected steps:\n{}".format("\n".join(self.inputs.perform_steps)))
 
+        # ANTs (with ITK and matplotlib) takes most of the start-up time, so it is only imported once the inputs are
+        # downloaded and the progress of the analysis is reported
+        import ants
+
         img = ants.image_read(fname1)
 
+        # Enforce dependency: segmentation required for thickness
+        if "do_thickness" in self.inputs.perform_steps and "do_segmentation" not in self.inputs.perform_steps:
+            self.inputs.perform_steps.append("do_segmentation")
+
+        # The brain mask is computed once, for the segmentation and for cropping the inputs of every step
+        mask = None
+        if self.inputs.crop_to_brain or "do_segmentation" in self.inputs.perform_steps:
+            mask = ants.get_mask(img)
+
+        crop = BrainCrop(img, mask if self.inputs.crop_to_brain else None, self.inputs.crop_padding)
+        if crop.box is not None:
+            logger.info("Cropping to the brain bounding box: {} of {} voxels".format(crop.voxels, crop.full_voxels))
+
         # --- Bias Field Correction ---
         if "do_biasfieldcorrection" in self.inputs.perform_steps:
             logger.info("Running N4 bias field correction")
-            image_n4 = ants.n4_bias_field_correction(img)
+            image_n4 = crop.paste(ants.n4_bias_field_correction(crop.crop(img)))
             image_n4.to_filename("n4_processed.nii.gz")
 
             generated_files.append("n4_processed.nii.gz")
@@ -172,67 +371,72 @@ class QmentaSDKToolMakerTutorial(Tool):
                 "description": "N4 bias field correction result",
             })
 
-        # Enforce dependency: segmentation required for thickness
-        if "do_thickness" in self.inputs.perform_steps and "do_segmentation" not in self.inputs.perform_steps:
-            self.inputs.perform_steps.append("do_segmentation")
-
-        # --- Tissue Segmentation ---
+        # --- Tissue Segmentation and Cortical Thickness ---
         if "do_segmentation" in self.inputs.perform_steps:
-            logger.info("Running tissue segmentation")
-            mask = ants.get_mask(img)
-
-            img_seg = ants.atropos(
-                a=img,
-                m=self.inputs.mrf,
-                c='[2,0]',
-                i='kmeans[3]',
-                x=mask
-            )
-
-            img_seg["segmentation"].to_filename("atropos_processed.nii.gz")
-            generated_files.append("atropos_processed.nii.gz")
-
-            report_items.append({
-                "header": "Tissue Segmentation",
-                "image": "segmentation.png",
-                "source_image": img_seg["segmentation"],
-                "description": "ANTs Atropos tissue segmentation",
-            })
-
-            # --- Cortical Thickness ---
-            if "do_thickness" in self.inputs.perform_steps:
-                logger.info("Running cortical thickness estimation")
-                thickimg = ants.kelly_kapowski(
-                    s=img_seg["segmentation"],
-                    g=img_seg["probabilityimages"][1],
-                    w=img_seg["probabilityimages"][2],
-                    its=45, r=0.5, m=1
-                )
-
-                thickimg.to_filename("thickness_processed.nii.gz")
-                generated_files.append("thickness_processed.nii.gz")
-
+            # One variant per MRF value. The first one keeps the original output names, shown in the Papaya viewer
+            variants = parse_mrf_values(self.inputs.mrf)
+            do_thickness = "do_thickness" in self.inputs.perform_steps
+            tasks = []
+            for index, mrf in enumerate(variants):
+                suffix = "" if index == 0 else mrf_suffix(mrf)
+                tasks.append((mrf, suffix, do_thickness))
+            logger.info("Running tissue segmentation{} for mrf {}".format(
+                " and cortical thickness" if do_thickness else "", ", ".join(variants)
+            ))
+
+            # The image and mask are loaded and cropped once, and sent once to each worker for all its variants
+            shared_inputs = (crop.crop(img), crop.crop(mask), crop)
+            if len(tasks) == 1:
+                _init_segmentation(shared_inputs)
+                results = [run_segmentation_variant(*tasks[0])]
+            else:
+                processes = min(len(tasks), os.cpu_count() or 1)
+                threads = max(1, (os.cpu_count() or 1) // processes)
+                # The cores are split between the workers. ITK threads are set up by the first image a process creates,
+                # so workers are not forked from this process but from a server that has only imported ants
+                pool_context = multiprocessing.get_context("forkserver")
+                pool_context.set_forkserver_preload(["ants"])
+                with pool_context.Pool(
+                    processes, initializer=_init_segmentation, initargs=(pickle.dumps(shared_inputs), threads)
+                ) as pool:
+                    results = pool.starmap(run_segmentation_variant, tasks)
+
+            for (mrf, suffix, _), result in zip(tasks, results):
+                logger.info("Variant with mrf {} took {:.1f} s".format(mrf, result["wall_time"]))
+                variant = " (mrf {}, {:.1f} s)".format(mrf, result["wall_time"])
+
+                generated_files.append(result["segmentation"])
                 report_items.append({
-                    "header": "Cortical Thickness",
-                    "image": "thickness.png",
-                    "overlay": thickimg,
-                    "base_image": img,
-                    "description": "Cortical thickness estimation",
+                    "header": "Tissue Segmentation",
+                    "image": "segmentation{}.png".format(suffix),
+                    "source_image": ants.image_read(result["segmentation"]),
+                    "description": "ANTs Atropos tissue segmentation" + variant,
                 })
 
+                if result["thickness"] is not None:
+                    generated_files.append(result["thickness"])
+                    report_items.append({
+                        "header": "Cortical Thickness",
+                        "image": "thickness{}.png".format(suffix),
+                        "overlay": ants.image_read(result["thickness"]),
+                        "base_image": img,
+                        "description": "Cortical thickness estimation" + variant,
+                    })
+
         # --- Registration ---
         if "do_registration" in self.inputs.perform_steps:
             logger.info("Running image registration")
-            fixed = ants.image_read(fname1)
+            fixed = img  # same file as the input image, already loaded
             moving = ants.image_read(fname2)
 
+            # The moving image is warped into the (cropped) grid of the fixed image
             tx = ants.registration(
-                fixed=fixed,
+                fixed=crop.crop(fixed),
                 moving=moving,
                 type_of_transform="SyN"
             )
 
-            warped = tx["warpedmovout"]
+            warped = crop.paste(tx["warpedmovout"])
             warped.to_filename("warped.nii.gz")
             generated_files.append("warped.nii.gz")
 
@@ -283,8 +487,13 @@ class QmentaSDKToolMakerTutorial(Tool):
         # ============================================================
         logger.info("Uploading outputs to QMENTA Platform")
 
-        # Upload original input image for reference
-        context.upload_file(
+        # Outputs whose bytes were already uploaded in this analysis are recorded as references in the upload
+        # manifest instead of being transferred again
+        uploader = UploadManager(context)
+
+        # Upload original input image for reference. It is transferred (once) rather than referenced to its input
+        # container because both Papaya viewers in the results configuration load it from the output container
+        uploader.upload_file(
             source_file_path=fname1,
             destination_path="input_image.nii.gz",
             modality=fname1_handler.get_file_modality(),
@@ -293,12 +502,25 @@ class QmentaSDKToolMakerTutorial(Tool):
 
         # Upload all generated outputs
         for filename in generated_files:
-            context.upload_file(filename, filename)
+            uploader.upload_file(filename, filename)
+
+        uploader.finish(output_dir)
 
         context.set_progress(value=100, message="Processing completed")
         logger.info("Tool execution finished successfully")
 
     def tool_outputs(self):
+        from qmenta.sdk.tool_maker.outputs import (
+            Coloring,
+            HtmlInject,
+            OrientationLayout,
+            PapayaViewer,
+            Region,
+            ResultsConfiguration,
+            Split,
+            Tab,
+        )
+
         # Main object to create the results configuration object.
         result_conf = ResultsConfiguration()
 
@@ -345,5 +567,13 @@ class QmentaSDKToolMakerTutorial(Tool):
 
 
 def run(context):
-    QmentaSDKToolMakerTutorial().tool_outputs()  # this can be removed if no results configuration file needs to be generated.
-    QmentaSDKToolMakerTutorial().run(context)
\ No newline at end of file
+    tool = QmentaSDKToolMakerTutorial()
+    # The results configuration is static, so it is generated when the docker image is built (see local/Dockerfile)
+    # and only here if it is missing or older than the tool (e.g. a tool.py mounted over the one of the image).
+    # This can be removed if no results configuration file needs to be generated.
+    results_configuration = os.path.join(tool.tool_path, "results_configuration.json")
+    if not os.path.isfile(results_configuration) or os.path.getmtime(results_configuration) < os.path.getmtime(
+        os.path.join(tool.tool_path, "tool.py")
+    ):
+        tool.tool_outputs()
+    tool.run(context)
\ No newline at end of file
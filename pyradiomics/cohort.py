@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import os
+import re
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from extraction import extract_label_features
+
+# Columns of the long-format feature table, one row per subject, label and feature
+COHORT_COLUMNS = ["subject", "label", "image_type", "feature_class", "feature", "value"]
+# Columns of the table of the subjects whose features could not be extracted
+FAILURE_COLUMNS = ["subject", "anat", "labels", "error"]
+
+_extractor = None  # Feature extractor of the current worker process, set by _init_worker
+_max_memory_mb = 0  # Memory budget of the current worker process, set by _init_worker
+
+
+def subject_name(path):
+    """Name a subject after its image file, without the NIfTI extension."""
+    name = os.path.basename(path)
+    for extension in (".nii.gz", ".nii"):
+        if name.endswith(extension):
+            return name[: -len(extension)]
+    return name
+
+
+def subject_stem(path):
+    """Leading part of a file name, up to the first "_", "-" or ".", e.g. ``patient001`` for ``patient001_mask.nii``."""
+    return re.split(r"[_.-]", subject_name(path), 1)[0]
+
+
+def _same_grid(anat_path, labels_path):
+    """Whether both NIfTI files have the same shape and affine, read from their headers only."""
+    anat_header, labels_header = nib.load(anat_path).header, nib.load(labels_path).header
+    return anat_header.get_data_shape() == labels_header.get_data_shape() and np.allclose(
+        anat_header.get_best_affine(), labels_header.get_best_affine()
+    )
+
+
+def pair_subjects(anat_files, labels_files):
+    """
+    Pair each image with its labels mask. Images and masks are matched in file name order, so both lists should
+    follow the same naming (e.g. ``patient001_image.nii.gz`` and ``patient001_mask.nii.gz``).
+
+    Each pair must either share the subject stem of its file names (``patient001``) or, when the names do not
+    follow that convention, have the same shape and affine in the NIfTI headers.
+
+    Parameters
+    ----------
+    anat_files : list of input_cache.FetchedFile
+        Images to analyze.
+    labels_files : list of input_cache.FetchedFile
+        Labels masks.
+
+    Returns
+    -------
+    list of tuple
+        ``(subject, anat_path, labels_path)`` for each subject.
+
+    Raises
+    ------
+    ValueError
+        If the number of images and masks differ, or an image is paired with a mask of another subject.
+    """
+    if len(anat_files) != len(labels_files):
+        raise ValueError(
+            "Cohort mode needs one labels mask per image, got {} images and {} masks".format(
+                len(anat_files), len(labels_files)
+            )
+        )
+    anat_files = sorted(anat_files, key=lambda f: f.handle.name)
+    labels_files = sorted(labels_files, key=lambda f: f.handle.name)
+    for anat, labels in zip(anat_files, labels_files):
+        if subject_stem(anat.handle.name) != subject_stem(labels.handle.name) and not _same_grid(
+            anat.path, labels.path
+        ):
+            raise ValueError(
+                "Image {!r} is paired with labels mask {!r}, which belongs to another subject: the file names do "
+                "not share a subject stem and the shape or affine of the images differ".format(
+                    anat.handle.name, labels.handle.name
+                )
+            )
+    return [(subject_name(anat.path), anat.path, labels.path) for anat, labels in zip(anat_files, labels_files)]
+
+
+def _init_worker(extractor, max_memory_mb=0):
+    global _extractor, _max_memory_mb
+    _extractor = extractor
+    _max_memory_mb = max_memory_mb
+
+
+def _extract_subject(pair):
+    """Extract the features of one subject, return the pair, its feature rows and its error (None on success)."""
+    subject, anat, labels = pair
+    rows = []
+    try:
+        mask_img = np.asanyarray(nib.load(labels).dataobj)
+        anat_img = sitk.GetImageFromArray(np.asanyarray(nib.load(anat).dataobj))
+        for label, features in extract_label_features(_extractor, anat_img, mask_img, _max_memory_mb):
+            for key, value in features.items():
+                if key.startswith("diagnostics_"):
+                    continue
+                image_type, feature_class, feature = key.split("_", 2)
+                rows.append((subject, int(label), image_type, feature_class, feature, float(value)))
+    except Exception as error:
+        # The exception itself may not be picklable, the parent process only needs its description
+        logging.getLogger(__name__).exception("Could not extract the features of subject {}".format(subject))
+        return pair, [], "{}: {}".format(type(error).__name__, error)
+    return pair, rows, None
+
+
+def run_cohort(context, extractor, pairs, output_dir, n_workers=0, max_memory_mb=0):
+    """
+    Extract the radiomic features of a cohort of subjects with a pool of worker processes.
+
+    The configured extractor is sent once to each worker and reused for all the subjects it processes. A subject
+    whose features cannot be extracted does not stop the others: it is left out of the feature table and listed with
+    its error in ``cohort_failures.csv``.
+
+    Parameters
+    ----------
+    context : qmenta.sdk.context.AnalysisContext
+        Analysis context object, used to report progress.
+    extractor : radiomics.featureextractor.RadiomicsFeatureExtractor
+        Configured feature extractor.
+    pairs : list of tuple
+        ``(subject, anat_path, labels_path)`` for each subject, as returned by ``pair_subjects``.
+    output_dir : str
+        Folder where the feature table is written.
+    n_workers : int
+        Number of worker processes. One per CPU if 0.
+    max_memory_mb : int
+        Memory budget in MB, split evenly between the workers. 0 for no limit.
+
+    Returns
+    -------
+    str
+        Path of the long-format CSV with the features of the subjects that succeeded.
+    str or None
+        Path of the CSV listing the subjects that failed, None if all of them succeeded.
+
+    Raises
+    ------
+    RuntimeError
+        If the features of every subject failed to be extracted.
+    """
+    logger = logging.getLogger(__name__)
+    processes = min(n_workers or os.cpu_count() or 1, len(pairs))
+    logger.info("Processing {} subjects with {} workers".format(len(pairs), processes))
+
+    rows = []
+    failures = []
+    # Each worker holds the images of one subject at a time, so the budget is shared evenly
+    worker_memory_mb = max(1, max_memory_mb // processes) if max_memory_mb else 0
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(extractor, worker_memory_mb))
+    try:
+        for done, (pair, subject_rows, error) in enumerate(pool.imap_unordered(_extract_subject, pairs), 1):
+            rows.extend(subject_rows)
+            if error is not None:
+                failures.append(pair + (error,))
+            context.set_progress(
+                value=20 + int(70 * done / len(pairs)),
+                message="Extracted radiomic features of {}/{} subjects".format(done, len(pairs)),
+            )
+    finally:
+        pool.close()
+        pool.join()
+
+    if failures and len(failures) == len(pairs):
+        raise RuntimeError(
+            "Could not extract the features of any subject, the first error was: {}".format(failures[0][-1])
+        )
+
+    # Subjects finish in any order, the stable sort keeps the feature order within each label
+    table = pd.DataFrame(rows, columns=COHORT_COLUMNS).sort_values(["subject", "label"], kind="mergesort")
+    cohort_csv = os.path.join(output_dir, "cohort_radiomic_features.csv")
+    table.to_csv(cohort_csv, index=False)
+
+    failures_csv = None
+    if failures:
+        logger.warning(
+            "Could not extract the features of {}/{} subjects: {}".format(
+                len(failures), len(pairs), ", ".join(sorted(failure[0] for failure in failures))
+            )
+        )
+        failures_csv = os.path.join(output_dir, "cohort_failures.csv")
+        pd.DataFrame(failures, columns=FAILURE_COLUMNS).sort_values("subject").to_csv(failures_csv, index=False)
+    return cohort_csv, failures_csv
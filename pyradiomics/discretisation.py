@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Feature classes computed on discretised grey levels only. First order also reads the raw intensities
+TEXTURE_CLASSES = ("glcm", "glrlm", "glszm", "gldm", "ngtdm")
+
+# Number of slices discretised at a time, to bound the size of the float64 temporaries
+_CHUNK_SLICES = 16
+
+
+def supports(extractor):
+    """Whether the grey levels of the extractor can be shared by all labels (fixed bin width, texture classes)."""
+    settings = extractor.settings
+    return (
+        any(feature_class in extractor.enabledFeatures for feature_class in TEXTURE_CLASSES)
+        and settings.get("binCount") is None
+        and settings.get("resegmentRange") is None
+        and not settings.get("voxelBased", False)
+    )
+
+
+def discretise(image_array, bin_width):
+    """
+    Discretise a whole image with a fixed bin width, into the smallest unsigned integer type that holds its levels.
+
+    pyradiomics bins the voxels of a label as ``floor(x / binWidth) - floor(min / binWidth) + 1``, where ``min`` is
+    the minimum of the label. The levels computed here are ``floor(x / binWidth)`` shifted by the minimum of the
+    image, so a label binned again with a bin width of 1 gets exactly the same grey levels.
+
+    Parameters
+    ----------
+    image_array : numpy.ndarray
+        Image to discretise.
+    bin_width : float
+        Width of the bins, in image intensity units.
+
+    Returns
+    -------
+    numpy.ndarray
+        Grey levels, starting at 0.
+    """
+    lowest = np.floor(np.min(image_array) / bin_width)
+    span = np.floor(np.max(image_array) / bin_width) - lowest
+    # pyradiomics adds 2 to the maximum level of a label when binning it, which must not overflow
+    dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32) if span <= np.iinfo(dtype).max - 2)
+    levels = np.empty(image_array.shape, dtype=dtype)
+    for start in range(0, image_array.shape[0], _CHUNK_SLICES):
+        chunk = np.asarray(image_array[start : start + _CHUNK_SLICES], dtype=np.float64)
+        levels[start : start + _CHUNK_SLICES] = np.floor(chunk / bin_width) - lowest
+    return levels
+
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import copy
+import logging
+from collections import Counter, OrderedDict
+
+import numpy as np
+import radiomics
+import SimpleITK as sitk
+from scipy import ndimage
+
+import discretisation
+import fast_features
+import memory_budget
+import multilabel_glcm
+import scale_space
+import wavelets
+
+# Settings that change the image before the filters are applied inside the extractor
+_PREPROCESSING_SETTINGS = ("normalize", "resampledPixelSpacing", "preCrop")
+
+# Voxel-wise filters that pyradiomics applies to the whole image, computed once with its own implementation
+_POINTWISE_IMAGE_TYPES = ("Logarithm", "Exponential", "Square", "SquareRoot")
+
+# Float32 volumes a filter keeps besides the image it yields, while waiting for the next image to be requested
+_FILTER_WORKING_VOLUMES = {"Original": 0, "Wavelet": 6, "LoG": 2}
+
+# Smallest number of voxels swept at a time by the GLCM of all labels, whatever the memory budget
+_MIN_GLCM_VOXELS = 1 << 16
+
+
+def build_extractor(settings):
+    """
+    Create a feature extractor configured with the feature classes and image filters selected by the user.
+
+    Parameters
+    ----------
+    settings : dict
+        Analysis settings, as returned by ``context.get_settings()``.
+
+    Returns
+    -------
+    radiomics.featureextractor.RadiomicsFeatureExtractor
+        Configured feature extractor.
+    """
+    extractor = radiomics.featureextractor.RadiomicsFeatureExtractor()
+    extractor.disableAllFeatures()
+    for feature_class in settings["feature_classes"]:  # The feature classes are retrieved from the settings
+        extractor.enableFeatureClassByName(feature_class)
+    for image_filter in settings["image_filters"]:  # The image filters are also retrieved from the settings
+        extractor.enableImageTypeByName(image_filter)
+        if image_filter == "LoG":
+            extractor.settings["sigma"] = scale_space.parse_sigmas(settings["sigma_LoG"])
+            extractor.settings["binWidth"] = settings["fwidth_LoG"]
+    return extractor
+
+
+def extract_label_features(extractor, anat_img, mask_img, max_memory_mb=0, export_image=None):
+    """
+    Compute the radiomic features of every label of a mask.
+
+    The shape and diagnostics are computed label by label. Then each filtered image is computed once, its features
+    extracted for all the labels, and the image released before the following ones are computed.
+
+    Parameters
+    ----------
+    extractor : radiomics.featureextractor.RadiomicsFeatureExtractor
+        Configured feature extractor.
+    anat_img : SimpleITK.Image
+        Image to analyze.
+    mask_img : numpy.ndarray
+        Labels mask, where 0 is the background.
+    max_memory_mb : int, optional
+        Memory budget of the process in MB, which bounds the number of filtered images resident at once. 0 for no
+        limit.
+    export_image : callable, optional
+        Called as ``export_image(image_type, image_type_name, array)`` with each filtered image of the whole anatomical
+        image (e.g. ``("Wavelet", "wavelet-HLH", array)``), before the image is released.
+
+    Returns
+    -------
+    list of tuple
+        ``(label, features)`` for each label, where ``features`` is the ordered dict returned by pyradiomics.
+    """
+    # Cheap features of all labels are computed at once instead of running the whole extraction label by label
+    if fast_features.supports(extractor):
+        return list(fast_features.extract_all_labels(extractor, anat_img, mask_img))
+
+    budget = memory_budget.MemoryBudget(max_memory_mb)
+    derived_types = _derived_image_types(extractor)
+    # The extractor only runs the filters that are not computed once for all labels
+    label_extractor = copy.copy(extractor)
+    label_extractor.enabledImagetypes = OrderedDict(
+        (image_type, kwargs)
+        for image_type, kwargs in extractor.enabledImagetypes.items()
+        if image_type not in derived_types
+    )
+
+    labels, compact = np.unique(mask_img, return_inverse=True)
+    compact = compact.reshape(mask_img.shape).astype(np.uint16 if len(labels) <= 1 << 16 else np.int32)
+    label_features = []
+    for label in labels[1:]:
+        label_mask = np.zeros_like(mask_img)
+        label_mask[mask_img == label] = 1
+        label_features.append(label_extractor.execute(anat_img, sitk.GetImageFromArray(label_mask)))
+        del label_mask
+
+    # Images discretised once for all labels, and the bytes of their grey levels and of their intensities
+    discretised_totals = Counter()
+    if derived_types:
+        # Bounding boxes of all labels in one pass, used to crop the images as the extractor does
+        regions = ndimage.find_objects(compact)
+        # Each image of a batch is resident with its grey levels. The filters hold their own working volumes
+        voxels = int(np.prod(mask_img.shape))
+        volume_bytes = voxels * (np.dtype(np.float32).itemsize + np.dtype(np.uint16).itemsize)
+        reserved_bytes = voxels * np.dtype(np.float32).itemsize * max(
+            _FILTER_WORKING_VOLUMES.get(image_type, 2) for image_type in derived_types
+        )
+        glcm_voxels = None
+        if max_memory_mb and "glcm" in extractor.enabledFeatures:
+            # The GLCM sweep holds padded copies of the labels and grey levels, and works on chunks of voxels that
+            # take at most a tenth of the budget
+            glcm_voxels = min(
+                voxels, max(_MIN_GLCM_VOXELS, max_memory_mb * 2 ** 20 // 10 // multilabel_glcm.SWEEP_BYTES_PER_VOXEL)
+            )
+            reserved_bytes += voxels * 2 * np.dtype(np.uint16).itemsize
+            reserved_bytes += glcm_voxels * multilabel_glcm.SWEEP_BYTES_PER_VOXEL
+        images = _iter_derived_images(extractor, anat_img, derived_types)
+        for batch in budget.batches(images, volume_bytes, reserved_bytes):
+            _extract_batch(
+                extractor, anat_img, compact, regions, batch, label_features, discretised_totals, glcm_voxels
+            )
+            if export_image is not None:
+                for image_type, image_type_name, image in batch:
+                    if image_type != "Original":
+                        export_image(image_type, image_type_name, image)
+
+    # Filters run by the extractor on the cropped image of each label are exported from the whole image
+    if export_image is not None:
+        for image_type in label_extractor.enabledImagetypes:
+            if image_type != "Original":
+                kwargs = _image_type_kwargs(extractor, image_type)
+                for image, image_type_name, _ in _pyradiomics_filter(anat_img, image_type, kwargs):
+                    export_image(image_type, image_type_name, sitk.GetArrayFromImage(image))
+
+    if discretised_totals["images"]:
+        logging.getLogger(__name__).info(
+            "Discretised {} images once for all labels: {:.1f} MB of grey levels for {:.1f} MB of intensities".format(
+                discretised_totals["images"],
+                discretised_totals["levels_bytes"] / 2 ** 20,
+                discretised_totals["intensities_bytes"] / 2 ** 20,
+            )
+        )
+    budget.report()
+    return list(zip(labels[1:], label_features))
+
+
+def _derived_image_types(extractor):
+    """Image types computed once on the whole image and shared by all the labels."""
+    if any(extractor.settings.get(setting) for setting in _PREPROCESSING_SETTINGS):
+        return []
+    return [
+        image_type
+        for image_type in extractor.enabledImagetypes
+        if image_type in ("Original", "LoG") + _POINTWISE_IMAGE_TYPES
+        or (image_type == "Wavelet" and wavelets.supports(_image_type_kwargs(extractor, image_type)))
+    ]
+
+
+def _iter_derived_images(extractor, anat_img, image_types):
+    """Compute the images of the given types one at a time, as ``(image_type, image_type_name, array)``."""
+    for image_type in image_types:
+        kwargs = _image_type_kwargs(extractor, image_type)
+        if image_type == "Original":
+            yield image_type, "original", sitk.GetArrayViewFromImage(anat_img)
+        elif image_type == "Wavelet":
+            for name, band in wavelets.iter_wavelet_bands(sitk.GetArrayViewFromImage(anat_img), **kwargs):
+                yield image_type, name, band
+        elif image_type == "LoG":
+            for name, response in scale_space.iter_log_images(anat_img, kwargs.get("sigma", [])):
+                yield image_type, name, response
+        else:
+            for image, name, _ in _pyradiomics_filter(anat_img, image_type, kwargs):
+                yield image_type, name, sitk.GetArrayFromImage(image)
+
+
+def _image_type_kwargs(extractor, image_type):
+    kwargs = extractor.settings.copy()
+    kwargs.update(extractor.enabledImagetypes[image_type])
+    return kwargs
+
+
+def _pyradiomics_filter(anat_img, image_type, kwargs):
+    # The mask is not used by the filters applied to the whole image
+    return getattr(radiomics.imageoperations, "get{}Image".format(image_type))(anat_img, anat_img, **kwargs)
+
+
+def _crop(array, reference_img, region):
+    """Crop an array in the (z, y, x) order of ``reference_img`` to a region given as a tuple of slices."""
+    return _region_image(array[region], reference_img, region)
+
+
+def _region_image(cropped_array, reference_img, region):
+    """Image of an array already cropped to a region of ``reference_img``, with the geometry of the region."""
+    cropped = sitk.GetImageFromArray(np.ascontiguousarray(cropped_array))
+    cropped.SetSpacing(reference_img.GetSpacing())
+    cropped.SetDirection(reference_img.GetDirection())
+    cropped.SetOrigin(reference_img.TransformIndexToPhysicalPoint([int(axis.start) for axis in region[::-1]]))
+    return cropped
+
+
+def _compute_features(extractor, image, levels, mask, image_type_name, kwargs, glcm_counts=None):
+    """
+    Same as ``extractor.computeFeatures``, with the texture classes reading grey levels discretised beforehand. Those
+    are binned again with a bin width of 1, which gives the grey levels pyradiomics would compute for the label. The
+    GLCM reads the co-occurrence counts of the label if they were computed for all labels at once.
+    """
+    features = OrderedDict()
+    feature_classes = radiomics.getFeatureClasses()
+    for class_name, feature_names in extractor.enabledFeatures.items():
+        if class_name.startswith("shape") or class_name not in feature_classes:
+            continue
+        if class_name == "glcm" and glcm_counts is not None:
+            feature_class = multilabel_glcm.LabelGLCM(levels, mask, glcm_counts, **dict(kwargs, binWidth=1))
+        elif levels is not None and class_name in discretisation.TEXTURE_CLASSES:
+            feature_class = feature_classes[class_name](levels, mask, **dict(kwargs, binWidth=1))
+        else:
+            feature_class = feature_classes[class_name](image, mask, **kwargs)
+        if feature_names is not None:
+            for feature_name in feature_names:
+                feature_class.enableFeatureByName(feature_name)
+        for feature_name, value in feature_class.execute().items():
+            features["%s_%s_%s" % (image_type_name, class_name, feature_name)] = value
+    return features
+
+
+def _extract_batch(extractor, anat_img, compact, regions, batch, label_features, discretised_totals, glcm_voxels=None):
+    """
+    Add the features of a batch of whole images to the features of every label, and add the images discretised to
+    ``discretised_totals``. The GLCM of all labels sweeps ``glcm_voxels`` voxels at a time, or the whole image if None.
+    """
+    # Grey levels of each image, computed once and cropped for every label and texture class
+    discretised = discretisation.supports(extractor)
+    needs_intensities = any(
+        feature_class not in discretisation.TEXTURE_CLASSES and not feature_class.startswith("shape")
+        for feature_class in extractor.enabledFeatures
+    )
+    prepared = []
+    for image_type, image_type_name, image in batch:
+        kwargs = _image_type_kwargs(extractor, image_type)
+        levels = glcm_counts = None
+        if discretised:
+            levels = discretisation.discretise(image, kwargs.get("binWidth", 25))
+            discretised_totals.update(images=1, levels_bytes=levels.nbytes, intensities_bytes=image.nbytes)
+            # Co-occurrence counts of all labels, one sweep over the discretised image per GLCM angle
+            if "glcm" in extractor.enabledFeatures and multilabel_glcm.supports(kwargs):
+                glcm_counts = multilabel_glcm.label_glcms(
+                    levels, compact, len(regions), kwargs.get("distances", [1]), glcm_voxels
+                )
+        prepared.append((image_type_name, image, levels, glcm_counts, kwargs))
+
+    for index, region in enumerate(regions):
+        cropped_mask = _region_image((compact[region] == index + 1).astype(np.uint8), anat_img, region)
+        for image_type_name, image, levels, glcm_counts, kwargs in prepared:
+            cropped_image = cropped_levels = counts = None
+            if levels is None or needs_intensities:
+                cropped_image = _crop(image, anat_img, region)
+            if levels is not None:
+                cropped_levels = _crop(levels, anat_img, region)
+            if glcm_counts is not None:
+                counts = glcm_counts[index]
+            label_features[index].update(
+                _compute_features(
+                    extractor, cropped_image, cropped_levels, cropped_mask, image_type_name, kwargs, counts
+                )
+            )
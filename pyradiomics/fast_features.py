@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+import collections
+
+import numpy as np
+import SimpleITK as sitk
+from radiomics import cShape
+from scipy import ndimage
+
+# Features computed by pyradiomics when the class is enabled, in the order it reports them
+FIRSTORDER_FEATURES = [
+    "10Percentile",
+    "90Percentile",
+    "Energy",
+    "Entropy",
+    "InterquartileRange",
+    "Kurtosis",
+    "Maximum",
+    "MeanAbsoluteDeviation",
+    "Mean",
+    "Median",
+    "Minimum",
+    "Range",
+    "RobustMeanAbsoluteDeviation",
+    "RootMeanSquared",
+    "Skewness",
+    "TotalEnergy",
+    "Uniformity",
+    "Variance",
+]
+SHAPE_FEATURES = [
+    "Elongation",
+    "Flatness",
+    "LeastAxisLength",
+    "MajorAxisLength",
+    "Maximum2DDiameterColumn",
+    "Maximum2DDiameterRow",
+    "Maximum2DDiameterSlice",
+    "Maximum3DDiameter",
+    "MeshVolume",
+    "MinorAxisLength",
+    "Sphericity",
+    "SurfaceArea",
+    "SurfaceVolumeRatio",
+    "VoxelVolume",
+]
+
+# Extractor settings that change the image or mask before extraction, which this engine does not reproduce
+_UNSUPPORTED_SETTINGS = ["normalize", "resampledPixelSpacing", "resegmentRange", "binCount", "correctMask"]
+
+
+def supports(extractor):
+    """
+    Check whether the features enabled in ``extractor`` can be computed by this engine: only first order and shape
+    features of the original image, with every feature of those classes enabled and no image preprocessing.
+
+    Parameters
+    ----------
+    extractor : radiomics.featureextractor.RadiomicsFeatureExtractor
+        Configured feature extractor.
+
+    Returns
+    -------
+    bool
+    """
+    if set(extractor.enabledImagetypes) != {"Original"}:
+        return False
+    if not extractor.enabledFeatures or not set(extractor.enabledFeatures) <= {"firstorder", "shape"}:
+        return False
+    if any(names for names in extractor.enabledFeatures.values()):  # Only a subset of the class is enabled
+        return False
+    return not any(extractor.settings.get(name) for name in _UNSUPPORTED_SETTINGS)
+
+
+def _group_percentile(sorted_values, starts, counts, q):
+    # Linear interpolation between closest ranks, as numpy.percentile
+    position = (counts - 1) * (q / 100.0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    fraction = position - lower
+    low_values = sorted_values[starts + lower]
+    return low_values + (sorted_values[starts + upper] - low_values) * fraction
+
+
+def _firstorder(values, index, n_labels, spacing, settings):
+    """Compute the first order features of every label. ``index`` holds the label index of each value."""
+    counts = np.bincount(index, minlength=n_labels).astype(np.float64)
+    shift = settings.get("voxelArrayShift", 0)
+    bin_width = settings.get("binWidth", 25)
+
+    # Sort voxels by label, then by value, so each label's values are a contiguous sorted run
+    order = np.lexsort((values, index))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts[:-1]))).astype(np.int64)
+    int_counts = counts.astype(np.int64)
+
+    minimum = sorted_values[starts]
+    maximum = sorted_values[starts + int_counts - 1]
+    p10 = _group_percentile(sorted_values, starts, int_counts, 10)
+    p25 = _group_percentile(sorted_values, starts, int_counts, 25)
+    median = _group_percentile(sorted_values, starts, int_counts, 50)
+    p75 = _group_percentile(sorted_values, starts, int_counts, 75)
+    p90 = _group_percentile(sorted_values, starts, int_counts, 90)
+
+    mean = np.bincount(index, weights=values, minlength=n_labels) / counts
+    deviation = values - mean[index]
+    m2 = np.bincount(index, weights=deviation ** 2, minlength=n_labels) / counts
+    m3 = np.bincount(index, weights=deviation ** 3, minlength=n_labels) / counts
+    m4 = np.bincount(index, weights=deviation ** 4, minlength=n_labels) / counts
+    mad = np.bincount(index, weights=np.abs(deviation), minlength=n_labels) / counts
+    energy = np.bincount(index, weights=(values + shift) ** 2, minlength=n_labels)
+
+    # Robust mean absolute deviation only uses the voxels between the 10th and 90th percentiles
+    robust = (values >= p10[index]) & (values <= p90[index])
+    robust_counts = np.bincount(index[robust], minlength=n_labels).astype(np.float64)
+    robust_mean = np.bincount(index[robust], weights=values[robust], minlength=n_labels) / robust_counts
+    robust_mad = (
+        np.bincount(index[robust], weights=np.abs(values[robust] - robust_mean[index[robust]]), minlength=n_labels)
+        / robust_counts
+    )
+
+    # Fixed bin width discretisation. Bin edges are multiples of binWidth, so the histogram of a label only depends
+    # on floor(x / binWidth) and all labels can be counted together. Only the occupied (label, bin) pairs are kept
+    bins = np.floor(values / bin_width).astype(np.int64)
+    bins -= bins.min()
+    n_bins = int(bins.max()) + 1
+    pairs, histogram = np.unique(index * n_bins + bins, return_counts=True)
+    pair_label = pairs // n_bins
+    p_i = histogram / counts[pair_label]
+    eps = np.spacing(1)
+    entropy = -np.bincount(pair_label, weights=p_i * np.log2(p_i + eps), minlength=n_labels)
+    uniformity = np.bincount(pair_label, weights=p_i ** 2, minlength=n_labels)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        skewness = np.where(m2 == 0, 0, m3 / m2 ** 1.5)
+        kurtosis = np.where(m2 == 0, 0, m4 / m2 ** 2.0)
+
+    return {
+        "10Percentile": p10,
+        "90Percentile": p90,
+        "Energy": energy,
+        "Entropy": entropy,
+        "InterquartileRange": p75 - p25,
+        "Kurtosis": kurtosis,
+        "Maximum": maximum,
+        "MeanAbsoluteDeviation": mad,
+        "Mean": mean,
+        "Median": median,
+        "Minimum": minimum,
+        "Range": maximum - minimum,
+        "RobustMeanAbsoluteDeviation": robust_mad,
+        "RootMeanSquared": np.sqrt(energy / counts),
+        "Skewness": skewness,
+        "TotalEnergy": energy * np.prod(spacing),
+        "Uniformity": uniformity,
+        "Variance": m2,
+    }
+
+
+def _shape(compact_mask, coordinates, index, n_labels, spacing, bounding_boxes):
+    """Compute the shape features of every label. Mesh based features are computed on each label's bounding box."""
+    counts = np.bincount(index, minlength=n_labels).astype(np.float64)
+    features = {name: np.zeros(n_labels) for name in SHAPE_FEATURES}
+    features["VoxelVolume"] = counts * np.prod(spacing)
+
+    # Principal axes: covariance of the physical coordinates, from grouped first and second order moments.
+    # Coordinates are taken relative to the bounding box corner to keep the moments small
+    lower = np.array([[box.start for box in bounding_box] for bounding_box in bounding_boxes])
+    physical = [(coordinates[d] - lower[index, d]) * spacing[d] for d in range(3)]
+    means = [np.bincount(index, weights=physical[d], minlength=n_labels) / counts for d in range(3)]
+    covariance = np.empty((n_labels, 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            moment = np.bincount(index, weights=physical[i] * physical[j], minlength=n_labels) / counts
+            covariance[:, i, j] = covariance[:, j, i] = moment - means[i] * means[j]
+    eigenvalues = np.linalg.eigvalsh(covariance)  # Sorted from small to large
+    eigenvalues[(eigenvalues < 0) & (eigenvalues > -1e-10)] = 0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        features["LeastAxisLength"] = np.sqrt(eigenvalues[:, 0]) * 4
+        features["MinorAxisLength"] = np.sqrt(eigenvalues[:, 1]) * 4
+        features["MajorAxisLength"] = np.sqrt(eigenvalues[:, 2]) * 4
+        features["Elongation"] = np.sqrt(eigenvalues[:, 1] / eigenvalues[:, 2])
+        features["Flatness"] = np.sqrt(eigenvalues[:, 0] / eigenvalues[:, 2])
+
+    for i, bounding_box in enumerate(bounding_boxes):
+        label_mask = np.pad(compact_mask[bounding_box] == i + 1, 1, mode="constant")
+        surface, volume, diameters = cShape.calculate_coefficients(label_mask, np.asarray(spacing, dtype=np.float64))
+        features["MeshVolume"][i] = volume
+        features["SurfaceArea"][i] = surface
+        features["SurfaceVolumeRatio"][i] = surface / volume
+        features["Sphericity"][i] = (36 * np.pi * volume ** 2) ** (1.0 / 3.0) / surface
+        features["Maximum2DDiameterSlice"][i] = diameters[0]
+        features["Maximum2DDiameterColumn"][i] = diameters[1]
+        features["Maximum2DDiameterRow"][i] = diameters[2]
+        features["Maximum3DDiameter"][i] = diameters[3]
+    return features
+
+
+def extract_all_labels(extractor, anat_img, mask_img):
+    """
+    Compute the first order and shape features of every label of a mask in a single pass over the volume.
+
+    Features are grouped reductions (``np.bincount`` over the label index of each voxel) instead of one
+    ``extractor.execute`` per label, and match the per-label pyradiomics output. Diagnostics only include the image
+    and mask information that is cheap to compute for all labels (no hashes nor connected volume counts).
+
+    Parameters
+    ----------
+    extractor : radiomics.featureextractor.RadiomicsFeatureExtractor
+        Configured feature extractor, for which ``supports`` returns True.
+    anat_img : SimpleITK.Image
+        Image to analyze.
+    mask_img : numpy.ndarray
+        Labels mask, where 0 is the background, with the same array layout as ``anat_img``.
+
+    Yields
+    ------
+    tuple
+        ``(label, features)`` for each label, with the same keys pyradiomics uses.
+    """
+    image_array = sitk.GetArrayFromImage(anat_img)
+    if image_array.shape != mask_img.shape:
+        raise ValueError("Image/Mask size mismatch: {} and {}".format(image_array.shape, mask_img.shape))
+    spacing = np.array(anat_img.GetSpacing()[::-1])  # In array (z, y, x) order
+    settings = extractor.settings
+    enabled = extractor.enabledFeatures
+
+    # Relabel to 0..N so labels index the grouped reductions directly. As in the per-label extraction, the lowest
+    # value of the mask is the background
+    labels, compact = np.unique(mask_img, return_inverse=True)
+    compact = compact.reshape(mask_img.shape).astype(np.uint16 if len(labels) <= 1 << 16 else np.int32)
+    labels = labels[1:]
+    n_labels = len(labels)
+    foreground = compact > 0
+    coordinates = np.nonzero(foreground)
+    index = compact[foreground] - 1
+    bounding_boxes = ndimage.find_objects(compact, max_label=n_labels)
+
+    min_dims = settings.get("minimumROIDimensions", 2)
+    for label, bounding_box in zip(labels, bounding_boxes):
+        ndims = sum(box.stop - box.start > 1 for box in bounding_box)
+        if ndims == 0:
+            raise ValueError("mask only contains 1 segmented voxel! Cannot extract features for a single voxel.")
+        elif ndims < min_dims:
+            raise ValueError(
+                "mask has too few dimensions (number of dimensions %d, minimum required %d)" % (ndims, min_dims)
+            )
+
+    results = {}
+    if "firstorder" in enabled:
+        values = image_array[foreground].astype(np.float64)
+        results["firstorder"] = _firstorder(values, index, n_labels, spacing, settings)
+    if "shape" in enabled:
+        results["shape"] = _shape(compact, coordinates, index, n_labels, spacing, bounding_boxes)
+
+    counts = np.bincount(index, minlength=n_labels)
+    centers = np.stack([np.bincount(index, weights=coordinates[d], minlength=n_labels) for d in range(3)], 1)
+    centers /= counts[:, None]
+    image_diagnostics = collections.OrderedDict(
+        [
+            ("diagnostics_Image-original_Dimensionality", "%iD" % anat_img.GetDimension()),
+            ("diagnostics_Image-original_Spacing", anat_img.GetSpacing()),
+            ("diagnostics_Image-original_Size", anat_img.GetSize()),
+            ("diagnostics_Image-original_Mean", np.mean(image_array)),
+            ("diagnostics_Image-original_Minimum", np.min(image_array)),
+            ("diagnostics_Image-original_Maximum", np.max(image_array)),
+            ("diagnostics_Mask-original_Spacing", anat_img.GetSpacing()),
+            ("diagnostics_Mask-original_Size", anat_img.GetSize()),
+        ]
+    )
+
+    for i, label in enumerate(labels):
+        # Diagnostics use SimpleITK (x, y, z) index order
+        bounding_box = bounding_boxes[i][::-1]
+        center_index = tuple(centers[i][::-1])
+        features = collections.OrderedDict(image_diagnostics)
+        features["diagnostics_Mask-original_BoundingBox"] = tuple(
+            [box.start for box in bounding_box] + [box.stop - box.start for box in bounding_box]
+        )
+        features["diagnostics_Mask-original_VoxelNum"] = int(counts[i])
+        features["diagnostics_Mask-original_CenterOfMassIndex"] = center_index
+        features["diagnostics_Mask-original_CenterOfMass"] = anat_img.TransformContinuousIndexToPhysicalPoint(
+            center_index
+        )
+        if "shape" in results:
+            for name in SHAPE_FEATURES:
+                features["original_shape_" + name] = results["shape"][name][i]
+        if "firstorder" in results:
+            for name in FIRSTORDER_FEATURES:
+                features["original_firstorder_" + name] = results["firstorder"][name][i]
+        yield label, features
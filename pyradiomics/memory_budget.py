@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import resource
+
+_MB = 2 ** 20
+
+
+def resident_mb():
+    """Current resident set size of the process, in MB."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / _MB
+    except (OSError, ValueError):
+        return peak_resident_mb()
+
+
+def peak_resident_mb():
+    """Peak resident set size of the process, in MB."""
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class MemoryBudget(object):
+    """
+    Schedules the filtered images of a subject so that the process stays within a memory budget.
+
+    The images are produced one at a time by a generator and processed in batches. The images of a batch are
+    resident together, and are released before the images of the next batch are produced. Batches hold as many
+    volumes as fit in the memory the process has left when the scheduling starts.
+
+    Parameters
+    ----------
+    max_memory_mb : int
+        Memory budget of the process, in MB. With 0 there is no limit, and all images form a single batch.
+    """
+
+    def __init__(self, max_memory_mb=0):
+        self.max_memory_mb = max_memory_mb or 0
+        self.batch_size = None
+
+    def batches(self, images, volume_bytes, reserved_bytes=0):
+        """
+        Group images in batches that fit in the budget.
+
+        Parameters
+        ----------
+        images : iterator
+            Images to schedule, produced when requested.
+        volume_bytes : int
+            Memory held by each image of a batch while it is processed.
+        reserved_bytes : int
+            Memory held by the generator of the images besides the images it produces.
+
+        Returns
+        -------
+        iterator of list
+            Batches of images. A batch is emptied once the next one is requested, so the caller must not keep other
+            references to its images.
+        """
+        self.batch_size = None
+        if self.max_memory_mb:
+            available = (self.max_memory_mb - resident_mb()) * _MB - reserved_bytes
+            self.batch_size = max(1, int(available // volume_bytes))
+            if available < volume_bytes:
+                logging.getLogger(__name__).warning(
+                    "Memory budget of {} MB is too small for the {:.0f} MB of a filtered image, "
+                    "processing them one at a time".format(self.max_memory_mb, volume_bytes / _MB)
+                )
+
+        batch = []
+        for image in images:
+            batch.append(image)
+            if len(batch) == self.batch_size:
+                yield batch
+                # Release the images of the batch before the next ones are produced
+                del batch[:]
+        if batch:
+            yield batch
+
+    def report(self):
+        """Log the peak resident set size of the process against the budget, and return it in MB."""
+        logger = logging.getLogger(__name__)
+        peak = peak_resident_mb()
+        if not self.max_memory_mb:
+            logger.info("Peak RSS {:.0f} MB, without memory budget".format(peak))
+        elif peak > self.max_memory_mb:
+            logger.warning(
+                "Peak RSS {:.0f} MB exceeds the memory budget of {} MB, with up to {} filtered images resident".format(
+                    peak, self.max_memory_mb, self.batch_size
+                )
+            )
+        else:
+            logger.info(
+                "Peak RSS {:.0f} MB within the memory budget of {} MB, with up to {} filtered images resident".format(
+                    peak, self.max_memory_mb, self.batch_size
+                )
+            )
+        return peak
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import radiomics.glcm
+from radiomics import cMatrices
+
+# Co-occurrence counts accumulated per sweep over the volume. Labels that do not fit are counted in another sweep
+_MAX_CELLS = 1 << 25
+
+# Peak memory of a sweep for each labelled voxel it holds (flat indices, labels, levels, rows and their temporaries)
+SWEEP_BYTES_PER_VOXEL = 96
+
+
+def supports(kwargs):
+    """Whether the GLCM settings of an image type can be computed by ``label_glcms``."""
+    return (
+        kwargs.get("weightingNorm") is None
+        and not kwargs.get("force2D", False)
+        and not kwargs.get("voxelBased", False)
+    )
+
+
+def glcm_angles(distances):
+    """Angles of the GLCM in (z, y, x) order, as generated by pyradiomics for a 3D region large enough for all."""
+    size = int(max(distances)) + 1
+    cube = np.ones((size, size, size), dtype=np.int64)
+    _, angles = cMatrices.calculate_glcm(cube, cube.astype(bool), np.array(distances), 1, False, 0)
+    return angles
+
+
+def label_glcms(levels, labels, n_labels, distances, max_voxels=None):
+    """
+    Co-occurrence counts of every label, sweeping the volume once per angle.
+
+    The volume is padded with background so that, in the flattened array, the neighbour of a voxel along an angle is
+    always at the same offset. For each angle, the voxel pairs whose two voxels belong to the same label are then
+    counted with a single bincount, indexed by label and grey levels. The counts of each label only span its own
+    grey level range, as in pyradiomics.
+
+    Parameters
+    ----------
+    levels : numpy.ndarray
+        Discretised image, as returned by ``discretisation.discretise``.
+    labels : numpy.ndarray
+        Labels mask of the same shape, with consecutive labels from 1 to ``n_labels`` and 0 as the background.
+    n_labels : int
+        Number of labels.
+    distances : list of int
+        Distances between the voxels of a pair.
+    max_voxels : int, optional
+        Number of voxels of the padded volume swept at a time, which bounds the working set of the sweep to about
+        ``SWEEP_BYTES_PER_VOXEL * max_voxels`` bytes besides the padded copies of ``levels`` and ``labels``. The
+        whole volume at once if not given.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        For each label, the counts in the layout of ``cMatrices.calculate_glcm``: shape ``(1, Ng, Ng, angles)``, where
+        grey level 1 is the lowest level of the label.
+    """
+    angles = glcm_angles(distances)
+    pad = int(max(distances))
+    padded_labels = np.pad(labels, pad, "constant").ravel()
+    padded_levels = np.pad(levels, pad, "constant").ravel()
+    strides = np.cumprod((1,) + tuple(np.array(levels.shape[:0:-1]) + 2 * pad))[::-1]
+    neighbour_offsets = np.asarray(angles).dot(strides)
+    chunk_size = max_voxels or padded_labels.size
+    chunks = [(start, start + chunk_size) for start in range(0, padded_labels.size, chunk_size)]
+
+    def labelled_voxels(start, stop):
+        """Flat indices, zero-based labels and grey levels of the labelled voxels of a chunk."""
+        voxels = np.flatnonzero(padded_labels[start:stop]) + start
+        return voxels, padded_labels[voxels].astype(np.int64) - 1, padded_levels[voxels].astype(np.int64)
+
+    lowest = np.full(n_labels, np.iinfo(np.int64).max, dtype=np.int64)
+    highest = np.full(n_labels, -1, dtype=np.int64)
+    for start, stop in chunks:
+        _, voxel_labels, voxel_levels = labelled_voxels(start, stop)
+        np.minimum.at(lowest, voxel_labels, voxel_levels)
+        np.maximum.at(highest, voxel_labels, voxel_levels)
+    n_levels = np.maximum(highest - lowest + 1, 1)
+
+    glcms = []
+    for first, last in _label_groups(n_levels ** 2 * len(angles)):
+        offsets = np.concatenate(([0], np.cumsum(n_levels[first:last] ** 2)))
+        counts = np.zeros((offsets[-1], len(angles)), dtype=np.float64)
+        for start, stop in chunks:
+            voxels, voxel_labels, voxel_levels = labelled_voxels(start, stop)
+            group = (voxel_labels >= first) & (voxel_labels < last)
+            group_voxels = voxels[group]
+            group_labels = padded_labels[group_voxels]
+            group_indices = voxel_labels[group]
+            group_lowest = lowest[group_indices]
+            # Index of the first cell of the row of each voxel, the level of its neighbour gives the column
+            rows = offsets[group_indices - first] + (voxel_levels[group] - group_lowest) * n_levels[group_indices]
+            rows -= group_lowest
+            del voxels, voxel_labels, voxel_levels, group, group_indices, group_lowest
+
+            for angle_index, neighbour_offset in enumerate(neighbour_offsets):
+                neighbours = group_voxels + neighbour_offset
+                pairs = padded_labels[neighbours] == group_labels
+                cells = rows[pairs] + padded_levels[neighbours[pairs]]
+                counts[:, angle_index] += np.bincount(cells, minlength=offsets[-1])
+        for label_index in range(first, last):
+            start = offsets[label_index - first]
+            size = n_levels[label_index]
+            glcms.append(counts[start : start + size ** 2].reshape(1, size, size, len(angles)))
+    return glcms
+
+
+def _label_groups(cells):
+    """Split consecutive labels into groups that each hold at most ``_MAX_CELLS`` counts (or a single label)."""
+    first = 0
+    total = 0
+    for label_index, label_cells in enumerate(cells):
+        if total and total + label_cells > _MAX_CELLS:
+            yield first, label_index
+            first, total = label_index, 0
+        total += label_cells
+    if len(cells):
+        yield first, len(cells)
+
+
+class LabelGLCM(radiomics.glcm.RadiomicsGLCM):
+    """
+    pyradiomics GLCM feature class that reads co-occurrence counts computed beforehand by ``label_glcms``, instead of
+    scanning the image of the label again. The matrix is then processed and the features computed as in pyradiomics.
+    """
+
+    def __init__(self, inputImage, inputMask, counts, **kwargs):
+        super(LabelGLCM, self).__init__(inputImage, inputMask, **kwargs)
+        self.counts = counts
+
+    def _calculateMatrix(self, voxelCoordinates=None):
+        P_glcm = self.counts.copy()
+
+        # Delete rows and columns that specify gray levels not present in the ROI
+        Ng = self.coefficients["Ng"]
+        emptyGrayLevels = np.setdiff1d(np.arange(1, Ng + 1), self.coefficients["grayLevels"]) - 1
+        P_glcm = np.delete(P_glcm, emptyGrayLevels, 1)
+        P_glcm = np.delete(P_glcm, emptyGrayLevels, 2)
+
+        if self.symmetricalGLCM:
+            P_glcm += np.transpose(P_glcm, (0, 2, 1, 3)).copy()
+
+        # Delete empty angles, and mark angles that are all empty with NaN so they are ignored
+        sumP_glcm = np.sum(P_glcm, (1, 2))
+        if P_glcm.shape[3] > 1:
+            emptyAngles = np.where(np.sum(sumP_glcm, 0) == 0)
+            if len(emptyAngles[0]) > 0:
+                P_glcm = np.delete(P_glcm, emptyAngles, 3)
+                sumP_glcm = np.delete(sumP_glcm, emptyAngles, 1)
+        sumP_glcm[sumP_glcm == 0] = np.nan
+        P_glcm /= sumP_glcm[:, None, None, :]
+
+        return P_glcm
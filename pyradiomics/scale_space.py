@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import numpy as np
+import SimpleITK as sitk
+
+
+def parse_sigmas(value):
+    """
+    Read the LoG sigma setting, a single value or several values separated by commas (e.g. ``"1.0, 2.5, 4"``).
+
+    Returns
+    -------
+    list of float
+        Sigma values in mm, without duplicates and in the order given.
+    """
+    if isinstance(value, (int, float)):
+        values = [value]
+    elif isinstance(value, str):
+        values = [item for item in value.replace(";", ",").split(",") if item.strip()]
+    else:
+        values = list(value)
+    sigmas = []
+    for item in values:
+        sigma = float(item)
+        if sigma not in sigmas:
+            sigmas.append(sigma)
+    if not sigmas:
+        raise ValueError("At least one LoG sigma value is needed, got {!r}".format(value))
+    return sigmas
+
+
+def log_image_name(sigma):
+    """Image type name given by pyradiomics to the LoG filtered image of a sigma (e.g. ``"log-sigma-2-0-mm-3D"``)."""
+    return "log-sigma-%s-mm-3D" % (str(sigma).replace(".", "-"))
+
+
+def iter_log_images(anat_img, sigmas):
+    """
+    Iterate over the Laplacian of Gaussian responses of an image at several scales, computing each one when it is
+    requested. The responses are those of ``radiomics.imageoperations.getLoGImage``.
+
+    The image is cast to float32 once for all scales. The recursive Gaussian filter has the same cost whatever the
+    sigma, so coarse scales are as cheap as fine ones.
+
+    Parameters
+    ----------
+    anat_img : SimpleITK.Image
+        Image to filter.
+    sigmas : list of float
+        Sigma values in mm.
+
+    Returns
+    -------
+    iterator of tuple
+        ``(image_type_name, array)`` for each sigma the filter can be applied with, in the order given, e.g.
+        ``("log-sigma-2-0-mm-3D", array)`` with a float32 array in SimpleITK (z, y, x) order.
+    """
+    logger = logging.getLogger(__name__)
+    size = np.array(anat_img.GetSize())
+    spacing = np.array(anat_img.GetSpacing())
+    if np.min(size) < 4:
+        logger.warning("Image too small to apply LoG filter, size: {}".format(size))
+        return
+
+    valid = []
+    for sigma in sigmas:
+        if sigma > 0.0 and np.all(size >= np.ceil(sigma / spacing) + 1):
+            valid.append(sigma)
+        else:
+            logger.warning("Skipping LoG sigma {}: it must be positive and fit in the image".format(sigma))
+
+    image = sitk.Cast(anat_img, sitk.sitkFloat32)
+    log_filter = sitk.LaplacianRecursiveGaussianImageFilter()
+    log_filter.SetNormalizeAcrossScale(True)
+    for sigma in valid:
+        log_filter.SetSigma(sigma)
+        yield log_image_name(sigma), sitk.GetArrayFromImage(log_filter.Execute(image))
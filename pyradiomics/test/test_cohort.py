@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "shared"))
+from cohort import pair_subjects, run_cohort
+from extraction import build_extractor
+from input_cache import FetchedFile
+
+
+def fetched(path):
+    return FetchedFile(SimpleNamespace(name=os.path.basename(path)), path, "", set())
+
+
+class TestCohort(unittest.TestCase):
+    """Tests for the multi-subject batch mode.
+    $ pytest pyradiomics/test/test_cohort.py
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_pairs_follow_file_name_order(self):
+        """Images and masks are matched by name order, whatever order the platform returns them in"""
+        anat = [fetched("/in/p002_image.nii.gz"), fetched("/in/p001_image.nii.gz")]
+        masks = [fetched("/in/p001_mask.nii.gz"), fetched("/in/p002_mask.nii.gz")]
+        self.assertEqual(
+            pair_subjects(anat, masks),
+            [
+                ("p001_image", "/in/p001_image.nii.gz", "/in/p001_mask.nii.gz"),
+                ("p002_image", "/in/p002_image.nii.gz", "/in/p002_mask.nii.gz"),
+            ],
+        )
+
+    def test_missing_mask_is_an_error(self):
+        """Every image needs its own mask"""
+        with self.assertRaises(ValueError):
+            pair_subjects([fetched("/in/a.nii.gz"), fetched("/in/b.nii.gz")], [fetched("/in/a_mask.nii.gz")])
+
+    def nifti(self, name, shape=(4, 5, 6), zoom=1.0):
+        """Write an empty labels image to the temporary folder, with the given grid."""
+        path = os.path.join(self.tmp_dir, name)
+        nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.int16), np.diag([zoom, zoom, zoom, 1.0])), path)
+        return fetched(path)
+
+    def test_pairs_of_different_subjects_are_an_error(self):
+        """A mask named after another subject, e.g. when the mask of a subject is missing, is not paired silently"""
+        anat = [self.nifti("p001_image.nii.gz"), self.nifti("p002_image.nii.gz", zoom=2.0)]
+        masks = [self.nifti("p002_mask.nii.gz", zoom=2.0), self.nifti("p003_mask.nii.gz", zoom=3.0)]
+        with self.assertRaises(ValueError):
+            pair_subjects(anat, masks)
+
+    def test_pairs_without_subject_stem_are_checked_on_the_headers(self):
+        """Names that do not share a stem are accepted only when the images have the same shape and affine"""
+        anat = self.nifti("image.nii.gz")
+        self.assertEqual(len(pair_subjects([anat], [self.nifti("labels.nii.gz")])), 1)
+        with self.assertRaises(ValueError):
+            pair_subjects([anat], [self.nifti("seg.nii.gz", shape=(4, 5, 7))])
+        with self.assertRaises(ValueError):
+            pair_subjects([anat], [self.nifti("roi.nii.gz", zoom=2.0)])
+
+    def test_invalid_mask_does_not_abort_the_cohort(self):
+        """The features of the other subjects are written, and the subject with the invalid mask is listed"""
+        image = np.random.RandomState(0).randint(0, 100, (10, 10, 10)).astype(np.int16)
+        mask = np.zeros((10, 10, 10), dtype=np.int16)
+        mask[2:8, 2:8, 2:8] = 1
+        for name, data in (("p001_image", image), ("p001_mask", mask), ("p002_image", image)):
+            nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(self.tmp_dir, name + ".nii.gz"))
+        with open(os.path.join(self.tmp_dir, "p002_mask.nii.gz"), "wb") as f:
+            f.write(b"not a NIfTI file")
+        path = os.path.join(self.tmp_dir, "{}_{}.nii.gz").format
+        pairs = [(subject, path(subject, "image"), path(subject, "mask")) for subject in ("p001", "p002")]
+        context = SimpleNamespace(set_progress=lambda value, message: None)
+        extractor = build_extractor({"feature_classes": ["firstorder"], "image_filters": ["Original"]})
+
+        cohort_csv, failures_csv = run_cohort(context, extractor, pairs, self.tmp_dir, n_workers=2)
+
+        self.assertEqual(set(pd.read_csv(cohort_csv)["subject"]), {"p001"})
+        self.assertEqual(list(pd.read_csv(failures_csv)["subject"]), ["p002"])
@@ -0,0 +1,52 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import radiomics
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import discretisation
+from extraction import build_extractor, extract_label_features
+
+
+class TestDiscretisation(unittest.TestCase):
+    """Validates the grey levels shared by all labels against the per-label pyradiomics discretisation.
+    $ pytest pyradiomics/test/test_discretisation.py
+    """
+
+    def test_label_grey_levels_match_pyradiomics(self):
+        """Binning a label of the whole-image levels with a bin width of 1 gives the levels pyradiomics computes"""
+        rng = np.random.default_rng(0)
+        image = rng.normal(0, 40, (12, 14, 16)).astype(np.float32)
+        levels = discretisation.discretise(image, 7.5)
+        self.assertEqual(levels.dtype, np.uint8)
+        for selection in (image > 30, image < -50, np.abs(image) < 5):
+            expected, _ = radiomics.imageoperations.binImage(image, selection, binWidth=7.5)
+            computed, _ = radiomics.imageoperations.binImage(levels, selection, binWidth=1)
+            np.testing.assert_array_equal(computed, expected)
+
+    def test_smallest_integer_type(self):
+        image = np.array([[[0.0, 2000.0]]])
+        self.assertEqual(discretisation.discretise(image, 25).dtype, np.uint8)
+        self.assertEqual(discretisation.discretise(image, 1).dtype, np.uint16)
+        self.assertEqual(discretisation.discretise(image, 0.01).dtype, np.uint32)
+
+    def test_texture_features_match_pyradiomics(self):
+        rng = np.random.default_rng(1)
+        anat_img = sitk.GetImageFromArray(rng.normal(100, 30, (14, 16, 18)).astype(np.float32))
+        mask = np.zeros((14, 16, 18), dtype=np.int16)
+        mask[1:7, 2:12, 3:14] = 4
+        mask[8:13, 9:15, 2:10] = 9
+        extractor = build_extractor(
+            {"feature_classes": ["firstorder", "glcm", "glrlm", "glszm", "gldm", "ngtdm"], "image_filters": ["Square"]}
+        )
+
+        computed = dict(extract_label_features(extractor, anat_img, mask))
+        for label in (4, 9):
+            expected = extractor.execute(anat_img, sitk.GetImageFromArray((mask == label).astype(np.int16)))
+            features = [key for key in expected if not key.startswith("diagnostics_")]
+            self.assertTrue(any("_ngtdm_" in key for key in features))
+            for key in features:
+                np.testing.assert_allclose(float(computed[label][key]), float(expected[key]), rtol=1e-10, err_msg=key)
@@ -0,0 +1,74 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fast_features
+from extraction import build_extractor
+
+
+def make_subject(seed=0, spacing=(0.8, 1.0, 2.5)):
+    """Random image with three labels of different shapes, one of them flat in one dimension."""
+    rng = np.random.default_rng(seed)
+    image = rng.normal(100, 30, (20, 24, 28)).astype(np.float32)
+    mask = np.zeros(image.shape, dtype=np.int16)
+    zz, yy, xx = np.mgrid[:20, :24, :28]
+    mask[(zz - 8) ** 2 + (yy - 10) ** 2 / 2.0 + (xx - 9) ** 2 < 30] = 3
+    mask[12:18, 4:20, 16:26] = 7
+    mask[2, 18:23, 18:27] = 12
+    anat_img = sitk.GetImageFromArray(image)
+    anat_img.SetSpacing(spacing)
+    return anat_img, mask
+
+
+class TestFastFeatures(unittest.TestCase):
+    """Validates the all-labels-at-once engine against the per-label pyradiomics extraction.
+    $ pytest pyradiomics/test/test_fast_features.py
+    """
+
+    def assert_matches_pyradiomics(self, feature_classes):
+        anat_img, mask = make_subject()
+        extractor = build_extractor({"feature_classes": feature_classes, "image_filters": []})
+        self.assertTrue(fast_features.supports(extractor))
+
+        expected = {}
+        for label in (3, 7, 12):
+            label_sitk = sitk.GetImageFromArray((mask == label).astype(np.int16))
+            label_sitk.CopyInformation(anat_img)
+            expected[label] = extractor.execute(anat_img, label_sitk)
+
+        computed = dict(fast_features.extract_all_labels(extractor, anat_img, mask))
+        self.assertEqual(sorted(computed), sorted(expected))
+        compared = 0
+        for label, features in expected.items():
+            for key, value in features.items():
+                # Hashes, versions and settings are not reproduced
+                if key not in computed[label] or isinstance(value, (str, dict)):
+                    continue
+                np.testing.assert_allclose(
+                    np.asarray(computed[label][key], dtype=float),
+                    np.asarray(value, dtype=float),
+                    rtol=1e-7,
+                    atol=1e-9,
+                    err_msg="{} of label {}".format(key, label),
+                )
+                compared += 1
+        return compared
+
+    def test_firstorder_and_shape_match_pyradiomics(self):
+        """All first order and shape features, and the numeric diagnostics, match pyradiomics"""
+        # 18 first order, 14 shape and 11 numeric diagnostics for each of the 3 labels
+        self.assertEqual(self.assert_matches_pyradiomics(["firstorder", "shape"]), 3 * 43)
+
+    def test_firstorder_only_matches_pyradiomics(self):
+        self.assert_matches_pyradiomics(["firstorder"])
+
+    def test_other_classes_or_filters_use_pyradiomics(self):
+        """The engine is only selected for the original image with first order and shape features"""
+        self.assertFalse(fast_features.supports(build_extractor({"feature_classes": ["glcm"], "image_filters": []})))
+        self.assertFalse(
+            fast_features.supports(build_extractor({"feature_classes": ["firstorder"], "image_filters": ["Wavelet"]}))
+        )
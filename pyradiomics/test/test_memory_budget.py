@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+import SimpleITK as sitk
+
+TOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(TOOL_DIR)
+import memory_budget
+from extraction import build_extractor, extract_label_features
+
+
+class TestMemoryBudget(unittest.TestCase):
+    """Validates the scheduling of the filtered images within a memory budget.
+    $ pytest pyradiomics/test/test_memory_budget.py
+    """
+
+    def test_batches_fit_in_budget(self):
+        budget = memory_budget.MemoryBudget(max_memory_mb=100)
+        with mock.patch.object(memory_budget, "resident_mb", return_value=60):
+            batches = [list(batch) for batch in budget.batches(range(7), volume_bytes=10 * 2 ** 20)]
+        self.assertEqual(batches, [[0, 1, 2, 3], [4, 5, 6]])
+
+        with mock.patch.object(memory_budget, "resident_mb", return_value=60):
+            batches = [list(batch) for batch in budget.batches(range(3), 10 * 2 ** 20, reserved_bytes=50 * 2 ** 20)]
+        self.assertEqual(batches, [[0], [1], [2]])
+
+        batches = [list(batch) for batch in memory_budget.MemoryBudget().batches(range(7), 10 * 2 ** 20)]
+        self.assertEqual(batches, [list(range(7))])
+
+    def test_batch_released_before_next_images(self):
+        """Images of a batch are no longer referenced by the batch when the next images are produced"""
+        budget = memory_budget.MemoryBudget(max_memory_mb=1)
+        produced = []
+
+        def images():
+            for index in range(3):
+                produced.append(index)
+                yield index
+
+        seen = []
+        for batch in budget.batches(images(), volume_bytes=1):
+            self.assertEqual(batch, [produced[-1]])
+            seen.append(batch)
+        self.assertEqual(seen, [[], [], []])
+
+    def test_features_and_exports_do_not_depend_on_budget(self):
+        rng = np.random.default_rng(0)
+        anat_img = sitk.GetImageFromArray(rng.normal(100, 30, (14, 16, 18)).astype(np.float32))
+        mask = np.zeros((14, 16, 18), dtype=np.int16)
+        mask[1:7, 2:12, 3:14] = 3
+        mask[8:13, 9:15, 2:10] = 5
+        extractor = build_extractor(
+            {
+                "feature_classes": ["firstorder", "glcm", "glszm"],
+                "image_filters": ["Wavelet", "LoG", "Exponential"],
+                "sigma_LoG": "1.0, 2.0",
+                "fwidth_LoG": 5.0,
+            }
+        )
+
+        results = []
+        for max_memory_mb in (0, 1):
+            exported = []
+            features = extract_label_features(
+                extractor, anat_img, mask, max_memory_mb, lambda *image: exported.append((image[1], image[2].copy()))
+            )
+            results.append((features, exported))
+
+        (unbounded, unbounded_exports), (bounded, bounded_exports) = results
+        self.assertEqual(len(bounded_exports), 8 + 2 + 1)
+        self.assertEqual([name for name, _ in bounded_exports], [name for name, _ in unbounded_exports])
+        for (_, image), (_, expected) in zip(bounded_exports, unbounded_exports):
+            np.testing.assert_array_equal(image, expected)
+        for (label, computed), (expected_label, expected) in zip(bounded, unbounded):
+            self.assertEqual(label, expected_label)
+            self.assertEqual(list(computed), list(expected))
+            for key in expected:
+                if not key.startswith("diagnostics_"):
+                    self.assertEqual(computed[key], expected[key], msg=key)
+
+    def test_peak_memory_within_budget_with_glcm(self):
+        """The filtered images and the GLCM sweep of all labels fit in a budget slightly above the resident memory"""
+        # Peak RSS is only meaningful in a fresh interpreter, the other tests already raised the peak of this one
+        script = """
+import numpy as np, SimpleITK as sitk, memory_budget
+from extraction import build_extractor, extract_label_features
+shape = (64, 128, 128)
+anat_img = sitk.GetImageFromArray(np.random.default_rng(0).normal(100, 30, shape).astype(np.float32))
+mask = np.zeros(shape, dtype=np.int16)
+mask[2:62, 4:124, 4:124] = 1
+mask[32:62, 64:124, 4:124] = 2
+extractor = build_extractor({"feature_classes": ["glcm"], "image_filters": ["Wavelet"]})
+budget = int(memory_budget.resident_mb()) + 100
+extract_label_features(extractor, anat_img, mask, budget)
+print(budget, memory_budget.peak_resident_mb())
+"""
+        budget, peak = subprocess.check_output([sys.executable, "-c", script], cwd=TOOL_DIR).split()
+        self.assertLessEqual(float(peak), float(budget))
@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+from radiomics import cMatrices
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import discretisation
+import multilabel_glcm
+from extraction import build_extractor, extract_label_features
+
+
+def make_subject(seed=0):
+    rng = np.random.default_rng(seed)
+    image = rng.normal(100, 30, (14, 16, 18)).astype(np.float32)
+    mask = np.zeros(image.shape, dtype=np.int16)
+    mask[1:6, 2:12, 3:14] = 2
+    mask[7:13, 9:15, 2:10] = 6
+    mask[7:13, 2:8, 11:17] = 11
+    mask[3, 13:15, 14:17] = 11  # Second component, far from the first one
+    return image, mask
+
+
+class TestMultilabelGLCM(unittest.TestCase):
+    """Validates the GLCM of all labels at once against the pyradiomics glcm class.
+    $ pytest pyradiomics/test/test_multilabel_glcm.py
+    """
+
+    def test_counts_match_pyradiomics(self):
+        """Counts of each label and angle are the ones pyradiomics computes on the label bounding box"""
+        image, mask = make_subject()
+        levels = discretisation.discretise(image, 20)
+        labels = np.searchsorted([0, 2, 6, 11], mask).astype(np.uint16)
+        distances = [1, 2]
+        angles = [tuple(angle) for angle in multilabel_glcm.glcm_angles(distances).tolist()]
+
+        glcms = multilabel_glcm.label_glcms(levels, labels, 3, distances)
+        for label_index, counts in enumerate(glcms, 1):
+            roi = labels == label_index
+            binned = np.zeros(levels.shape, dtype=np.int64)
+            binned[roi] = levels[roi] - levels[roi].min() + 1
+            box = tuple(slice(indices.min(), indices.max() + 1) for indices in np.nonzero(roi))
+            # The C extension needs contiguous arrays, as pyradiomics passes them
+            expected, expected_angles = cMatrices.calculate_glcm(
+                np.ascontiguousarray(binned[box]),
+                np.ascontiguousarray(roi[box]),
+                np.array(distances),
+                int(binned.max()),
+                False,
+                0,
+            )
+            columns = [angles.index(tuple(angle)) for angle in expected_angles.tolist()]
+            np.testing.assert_array_equal(counts[..., columns], expected)
+            self.assertEqual(np.delete(counts, columns, 3).sum(), 0)
+
+    def test_features_match_pyradiomics(self):
+        image, mask = make_subject()
+        anat_img = sitk.GetImageFromArray(image)
+        for settings in ({}, {"symmetricalGLCM": False, "distances": [1, 2]}):
+            extractor = build_extractor({"feature_classes": ["glcm"], "image_filters": ["Wavelet"]})
+            extractor.settings.update(settings)
+
+            computed = dict(extract_label_features(extractor, anat_img, mask))
+            for label in (2, 6, 11):
+                expected = extractor.execute(anat_img, sitk.GetImageFromArray((mask == label).astype(np.int16)))
+                features = [key for key in expected if "_glcm_" in key]
+                self.assertEqual(len(features), 9 * 24)
+                for key in features:
+                    np.testing.assert_allclose(
+                        float(computed[label][key]), float(expected[key]), rtol=1e-9, atol=1e-12, err_msg=key
+                    )
+
+    def test_labels_split_in_several_sweeps(self):
+        """Labels whose counts do not fit in one sweep are counted in the following ones"""
+        image, mask = make_subject()
+        levels = discretisation.discretise(image, 20)
+        labels = np.searchsorted([0, 2, 6, 11], mask).astype(np.uint16)
+        expected = multilabel_glcm.label_glcms(levels, labels, 3, [1])
+        max_cells = multilabel_glcm._MAX_CELLS
+        multilabel_glcm._MAX_CELLS = 1
+        try:
+            computed = multilabel_glcm.label_glcms(levels, labels, 3, [1])
+        finally:
+            multilabel_glcm._MAX_CELLS = max_cells
+        for counts, expected_counts in zip(computed, expected):
+            np.testing.assert_array_equal(counts, expected_counts)
+
+    def test_sweep_in_voxel_chunks(self):
+        """Counts do not depend on the number of voxels swept at a time"""
+        image, mask = make_subject()
+        levels = discretisation.discretise(image, 20)
+        labels = np.searchsorted([0, 2, 6, 11], mask).astype(np.uint16)
+        expected = multilabel_glcm.label_glcms(levels, labels, 3, [1, 2])
+        for max_voxels in (50, 97, 1000):
+            computed = multilabel_glcm.label_glcms(levels, labels, 3, [1, 2], max_voxels)
+            for counts, expected_counts in zip(computed, expected):
+                np.testing.assert_array_equal(counts, expected_counts)
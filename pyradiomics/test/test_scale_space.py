@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+import radiomics
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import scale_space
+from extraction import build_extractor, extract_label_features
+
+
+class TestScaleSpace(unittest.TestCase):
+    """Validates the multi-sigma LoG filtering against the pyradiomics LoG filter.
+    $ pytest pyradiomics/test/test_scale_space.py
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.anat_img = sitk.GetImageFromArray(np.round(rng.normal(100, 30, (15, 18, 21))).astype(np.int16))
+        self.anat_img.SetSpacing((0.8, 1.0, 2.5))
+
+    def test_sigma_setting(self):
+        self.assertEqual(scale_space.parse_sigmas(2), [2.0])
+        self.assertEqual(scale_space.parse_sigmas("1.0, 2.5,4, 1"), [1.0, 2.5, 4.0])
+        with self.assertRaises(ValueError):
+            scale_space.parse_sigmas(" ")
+
+    def test_responses_match_pyradiomics(self):
+        """One response per sigma, named and valued as pyradiomics does, skipping sigmas too large for the image"""
+        sigmas = [1.0, 3.0, 50.0]
+        expected = [
+            (name, sitk.GetArrayFromImage(image))
+            for image, name, _ in radiomics.imageoperations.getLoGImage(self.anat_img, self.anat_img, sigma=sigmas)
+        ]
+        computed = OrderedDict(scale_space.iter_log_images(self.anat_img, sigmas))
+        self.assertEqual(list(computed), ["log-sigma-1-0-mm-3D", "log-sigma-3-0-mm-3D"])
+        self.assertEqual(list(computed), [name for name, _ in expected])
+        for name, response in expected:
+            self.assertEqual(computed[name].dtype, np.float32)
+            np.testing.assert_array_equal(computed[name], response, err_msg=name)
+
+    def test_features_of_every_sigma(self):
+        # The tool builds its images from the NIfTI arrays, with unit spacing
+        self.anat_img.SetSpacing((1.0, 1.0, 1.0))
+        mask = np.zeros(self.anat_img.GetSize()[::-1], dtype=np.int16)
+        mask[2:9, 3:12, 4:15] = 1
+        extractor = build_extractor(
+            {"feature_classes": ["firstorder"], "image_filters": ["LoG"], "sigma_LoG": "1.0, 2.0", "fwidth_LoG": 5.0}
+        )
+        (label, computed), = extract_label_features(extractor, self.anat_img, mask)
+        expected = extractor.execute(self.anat_img, sitk.GetImageFromArray(mask))
+        features = [key for key in expected if not key.startswith("diagnostics_")]
+        self.assertTrue(any(key.startswith("log-sigma-2-0-mm-3D_") for key in features))
+        for key in features:
+            self.assertAlmostEqual(float(computed[key]), float(expected[key]), msg=key)
@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+import unittest
+
+TOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+class TestToolStartup(unittest.TestCase):
+    """Validates that the tool module starts without loading the processing libraries.
+    $ pytest pyradiomics/test/test_tool_startup.py
+    """
+
+    def test_heavy_modules_not_imported_at_load(self):
+        # A fresh interpreter, the modules of the other tests are already loaded in this one
+        heavy_modules = ("radiomics", "SimpleITK", "pandas", "nibabel", "scipy")
+        script = "import sys, tool; print(' '.join(m for m in {!r} if m in sys.modules))".format(heavy_modules)
+        loaded = subprocess.check_output([sys.executable, "-c", script], cwd=TOOL_DIR)
+        self.assertEqual(loaded.decode().strip(), "")
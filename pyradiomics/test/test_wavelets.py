@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+import radiomics
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import wavelets
+from extraction import build_extractor, extract_label_features
+
+
+class TestWavelets(unittest.TestCase):
+    """Validates the wavelet decomposition computed once for all labels against the pyradiomics wavelet filter.
+    $ pytest pyradiomics/test/test_wavelets.py
+    """
+
+    def setUp(self):
+        # Odd sizes exercise the padding needed by the stationary transform
+        rng = np.random.default_rng(0)
+        self.image = rng.normal(100, 30, (15, 18, 21)).astype(np.float32)
+        self.anat_img = sitk.GetImageFromArray(self.image)
+
+    def test_sub_bands_match_pyradiomics(self):
+        """Same sub-bands and values, in the same order except for the approximation, which comes first"""
+        expected = [
+            (name, sitk.GetArrayFromImage(image))
+            for image, name, _ in radiomics.imageoperations.getWaveletImage(self.anat_img, self.anat_img)
+        ]
+        computed = OrderedDict(wavelets.iter_wavelet_bands(self.image))
+        self.assertEqual(list(computed), [expected[-1][0]] + [name for name, _ in expected[:-1]])
+        for name, band in expected:
+            self.assertEqual(computed[name].dtype, np.float32)
+            np.testing.assert_array_equal(computed[name], band, err_msg=name)
+
+    def test_integer_images_are_decomposed_in_float32(self):
+        image = np.round(self.image).astype(np.int16)
+        anat_img = sitk.GetImageFromArray(image)
+        computed = dict(wavelets.iter_wavelet_bands(image, wavelet="haar"))
+        for band, name, _ in radiomics.imageoperations.getWaveletImage(anat_img, anat_img, wavelet="haar"):
+            np.testing.assert_allclose(computed[name], sitk.GetArrayFromImage(band), rtol=1e-5, atol=1e-3)
+
+    def test_features_match_pyradiomics(self):
+        """Features of the filtered images computed once match the extractor filtering the image for each label"""
+        mask = np.zeros(self.image.shape, dtype=np.int16)
+        mask[2:9, 3:12, 4:15] = 2
+        mask[10:14, 10:17, 2:9] = 5
+        extractor = build_extractor({"feature_classes": ["firstorder", "glcm"], "image_filters": ["Wavelet"]})
+
+        computed = dict(extract_label_features(extractor, self.anat_img, mask))
+        for label in (2, 5):
+            expected = extractor.execute(self.anat_img, sitk.GetImageFromArray((mask == label).astype(np.int16)))
+            for key, value in expected.items():
+                if key.startswith("diagnostics_"):
+                    continue
+                self.assertAlmostEqual(float(computed[label][key]), float(value), msg=key)
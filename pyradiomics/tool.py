@@ -1,12 +1,28 @@
 # -*- coding: utf-8 -*-
+import importlib
 import os
-from collections import namedtuple
+import sys
+import threading
+from collections import OrderedDict, namedtuple
 
-import nibabel as nib
-import numpy as np
-import pandas as pd
-import radiomics
-import SimpleITK as sitk
+try:
+    from input_cache import fetch_inputs
+    from upload_manager import UploadManager
+except ImportError:
+    # Local runs: the modules shared with the ANTs tool live in the shared folder of the repository, the Docker image
+    # has them next to tool.py
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+    from input_cache import fetch_inputs
+    from upload_manager import UploadManager
+
+# Modules that take most of the start-up time of the tool (pyradiomics, SimpleITK, scipy, nibabel, pandas). They are
+# imported by the stage that needs them, so the analysis reports progress and starts downloading its inputs first
+_PROCESSING_MODULES = ("extraction", "cohort", "nibabel", "pandas")
+
+
+def _import_processing_modules():
+    for name in _PROCESSING_MODULES:
+        importlib.import_module(name)
 
 
 def run(context):
@@ -29,43 +45,69 @@ def run(context):
     os.makedirs(output_dir, exist_ok=True)
     context.set_progress(value=0, message="Processing")  # Set progress status so it is displayed in the platform
 
-    """ Get the input data """
+    # Load the processing modules in the background while the inputs are downloaded
+    preload = threading.Thread(target=_import_processing_modules, daemon=True)
+    preload.start()
 
-    # Retrieve input files
-    anat = context.get_files("input_anat", file_filter_condition_name="c_anat")[0].download(input_dir)
-    modality = context.get_files("input_anat", file_filter_condition_name="c_anat")[0].get_file_modality()
+    """ Get the input data """
 
-    labels = context.get_files("input_mask", file_filter_condition_name="c_labels")[0].download(input_dir)
-    tags = context.get_files("input_mask", file_filter_condition_name="c_labels")[0].get_file_tags()
+    # Retrieve input files. The file handles are resolved once and all files are downloaded concurrently,
+    # reusing the copy in the local input cache when the same subject was already fetched on this node
+    fetched = fetch_inputs(context, [("input_anat", "c_anat"), ("input_mask", "c_labels")], input_dir)
+    anat_files = fetched["input_anat", "c_anat"]
+    labels_files = fetched["input_mask", "c_labels"]
 
     # Retrieve settings
     settings = context.get_settings()
 
-    # Load input data into memory
-    mask_nib = nib.load(labels)
-    mask_img = mask_nib.get_data()
-    anat_img = sitk.GetImageFromArray(nib.load(anat).get_data())
-
     """ Processing code """
 
+    # Wait for the processing modules, the worker processes of the cohort mode must not be forked mid-import
+    preload.join()
+    from extraction import build_extractor, extract_label_features
+
     # Create feature extractor with user specified settings
     context.set_progress(value=10, message="Instantiating feature extractor")
-
-    extractor = radiomics.featureextractor.RadiomicsFeatureExtractor()
-    extractor.disableAllFeatures()
-    for feature_class in settings["feature_classes"]:  # The feature classes are retrieved from the settings
-        extractor.enableFeatureClassByName(feature_class)
-    for image_filter in settings["image_filters"]:  # The image filters are also retrieved from the settings
-        extractor.enableImageTypeByName(image_filter)
-        if image_filter == "LoG":
-            extractor.settings["sigma"] = [settings["sigma_LoG"]]
-            extractor.settings["binWidth"] = settings["fwidth_LoG"]
+    extractor = build_extractor(settings)
 
     # Print extractor parameters for debugging and info
     print("Extraction parameters:\n\t", extractor.settings)
     print("Enabled filters:\n\t", extractor.enabledImagetypes)
     print("Enabled features:\n\t", extractor.enabledFeatures)
 
+    uploader = UploadManager(context)
+
+    # Cohort mode: several image/mask pairs share the extractor and produce a single long-format feature table
+    if len(anat_files) > 1 or len(labels_files) > 1:
+        from cohort import pair_subjects, run_cohort
+
+        context.set_progress(value=20, message="Extracting radiomic features")
+        pairs = pair_subjects(anat_files, labels_files)
+        cohort_csv, failures_csv = run_cohort(
+            context, extractor, pairs, output_dir, settings.get("n_workers", 0), settings.get("max_memory_mb", 0)
+        )
+
+        context.set_progress(value=90, message="Uploading results")
+        uploader.upload_file(cohort_csv, "cohort_radiomic_features.csv", tags={"csv"})
+        if failures_csv is not None:
+            uploader.upload_file(failures_csv, "cohort_failures.csv", tags={"csv"})
+        uploader.finish(output_dir)
+        return
+
+    anat_file = anat_files[0]
+    labels_file = labels_files[0]
+    anat = anat_file.path
+    labels = labels_file.path
+
+    import nibabel as nib
+    import pandas as pd
+    import SimpleITK as sitk
+
+    # Load input data into memory
+    mask_nib = nib.load(labels)
+    mask_img = mask_nib.get_data()
+    anat_img = sitk.GetImageFromArray(nib.load(anat).get_data())
+
     # Initialize all necessary dataframes and dicts
     original_rds_df = pd.DataFrame()
     original_rds_dict = {}
@@ -77,9 +119,10 @@ def run(context):
         for name in wavelet_names:
             wavelets[name] = Wavelet(pd.DataFrame(), {})
 
+    # One table per LoG sigma, keyed by the name of its filtered image (e.g. "log-sigma-2-0-mm-3D")
     if "LoG" in settings["image_filters"]:
-        log_rds_df = pd.DataFrame()
-        log_rds_dict = {}
+        log_rds_dfs = OrderedDict()
+        log_rds_dicts = OrderedDict()
 
     if "Logarithm" in settings["image_filters"]:
         logarithm_rds_df = pd.DataFrame()
@@ -89,19 +132,40 @@ def run(context):
         exp_rds_df = pd.DataFrame()
         exp_rds_dict = {}
 
-    # Compute radiomic features for each label and puts them in a separate sheet in the excel
-    context.set_progress(value=20, message="Extracting radiomic features")
-    for label in np.unique(mask_img)[1:]:
-        label_mask = np.zeros_like(mask_img)
-        label_mask[mask_img == label] = 1
-        label_sitk = sitk.GetImageFromArray(label_mask)
-        features = extractor.execute(anat_img, label_sitk)
+    radiomics_csv_to_upload = []  # List[Tuple[src_filepath : str, dst_platform_path : str, tags : Set]]
+    filtered_images_to_upload = []  # List[Tuple[src_filepath : str, dst_platform_path : str, tags : Set]]
+
+    # Platform folder and tag of the filtered images of each image filter
+    filtered_image_outputs = {
+        "Wavelet": ("Wavelet/", "wavelet"),
+        "LoG": ("LoG/", "LoG"),
+        "Logarithm": ("Logarithm/", "logarithm"),
+        "Exponential": ("Exponential/", "exponential"),
+    }
+
+    def export_filtered_image(image_type, name, filtered_array):
+        # Called as soon as the features of a filtered image are computed, so the image can be released afterwards
+        folder, tag = filtered_image_outputs[image_type]
+        src_filepath = os.path.join(output_dir, name + "_filtered_image.nii.gz")
+        dst_platform_path = folder + name + "_filtered_image.nii.gz"
+        tags = {tag}
 
+        nib.save(nib.Nifti1Image(filtered_array, mask_nib.affine, mask_nib.header), src_filepath)
+
+        filtered_images_to_upload.append((src_filepath, dst_platform_path, tags))
+
+    # Compute radiomic features for each label and puts them in a separate sheet in the excel. The filtered images
+    # are computed and exported one batch at a time, as many as fit in the memory budget
+    context.set_progress(value=20, message="Extracting radiomic features")
+    label_features = extract_label_features(
+        extractor, anat_img, mask_img, settings.get("max_memory_mb", 0), export_filtered_image
+    )
+    for label, features in label_features:
         for key, value in features.items():
             if "original" in key:
                 original_rds_dict[key] = [value]
             elif "sigma" in key:
-                log_rds_dict[key] = [value]
+                log_rds_dicts.setdefault(key.split("_", 1)[0], {})[key] = [value]
             elif "logarithm" in key:
                 logarithm_rds_dict[key] = [value]
             elif "exponential" in key:
@@ -121,8 +185,9 @@ def run(context):
                 wavelets[name]._replace(dict={})
 
         if "LoG" in settings["image_filters"]:
-            log_rds_df["label" + str(label)] = pd.Series(log_rds_dict)
-            log_rds_dict = {}
+            for log_name, log_rds_dict in log_rds_dicts.items():
+                log_rds_dfs.setdefault(log_name, pd.DataFrame())["label" + str(label)] = pd.Series(log_rds_dict)
+            log_rds_dicts = OrderedDict()
 
         if "Logarithm" in settings["image_filters"]:
             logarithm_rds_df["label" + str(label)] = pd.Series(logarithm_rds_dict)
@@ -132,26 +197,11 @@ def run(context):
             exp_rds_df["label" + str(label)] = pd.Series(exp_rds_dict)
             exp_rds_dict = {}
 
-    # Create CSV with radiomics features and obtain filtered images
+    # Create CSV with radiomics features
     original_radiomics_csv = os.path.join(output_dir, "original_radiomic_features.csv")
     original_rds_df.to_csv(original_radiomics_csv)
-    radiomics_csv_to_upload = []  # List[Tuple[src_filepath : str, dst_platform_path : str, tags : Set]]
-    filtered_images_to_upload = []  # List[Tuple[src_filepath : str, dst_platform_path : str, tags : Set]]
 
     if "Wavelet" in settings["image_filters"]:
-        wavelet_generator = radiomics.imageoperations.getWaveletImage(anat_img, sitk.GetImageFromArray(mask_img))
-        for wavelet in wavelet_generator:
-            src_filepath = os.path.join(output_dir, wavelet[1] + "_filtered_image.nii.gz")
-            dst_platform_path = "Wavelet/" + wavelet[1] + "_filtered_image.nii.gz"
-            tags = {"wavelet"}
-
-            nib.save(
-                nib.Nifti1Image(sitk.GetArrayFromImage(wavelet[0]), mask_nib.affine, mask_nib.header),
-                src_filepath,
-            )
-
-            filtered_images_to_upload.append((src_filepath, dst_platform_path, tags))
-
         for name in wavelet_names:
             dst_platform_path = "Wavelet/wavelet_{}_radiomic_features.csv".format(name)
             src_filepath = os.path.join(output_dir, "wavelet_{}_radiomic_features.csv".format(name))
@@ -162,45 +212,19 @@ def run(context):
             radiomics_csv_to_upload.append((src_filepath, dst_platform_path, tags))
 
     if "LoG" in settings["image_filters"]:
-        log_generator = radiomics.imageoperations.getLoGImage(
-            anat_img, sitk.GetImageFromArray(mask_img), sigma=[settings["sigma_LoG"]], binWidth=settings["fwidth_LoG"]
-        )
-        log_image = next(log_generator)
-
-        src_filepath = os.path.join(output_dir, log_image[1] + "_filtered_image.nii.gz")
-        dst_platform_path = "LoG/" + log_image[1] + "_filtered_image.nii.gz"
-        tags = {"LoG"}
-
-        nib.save(
-            nib.Nifti1Image(sitk.GetArrayFromImage(log_image[0]), mask_nib.affine, mask_nib.header),
-            src_filepath,
-        )
-
-        filtered_images_to_upload.append((src_filepath, dst_platform_path, tags))
+        # With a single sigma the feature table keeps its original name
+        single_sigma = len(extractor.settings["sigma"]) == 1
+        for name, log_rds_df in log_rds_dfs.items():
+            csv_name = "LoG_radiomic_features.csv" if single_sigma else name + "_radiomic_features.csv"
+            dst_platform_path = "LoG/" + csv_name
+            src_filepath = os.path.join(output_dir, csv_name)
+            tags = {"LoG", "csv"}
 
-        dst_platform_path = "LoG/LoG_radiomic_features.csv"
-        src_filepath = os.path.join(output_dir, "LoG_radiomic_features.csv")
-        tags = {"LoG", "csv"}
+            log_rds_df.to_csv(src_filepath)
 
-        log_rds_df.to_csv(src_filepath)
-
-        radiomics_csv_to_upload.append((src_filepath, dst_platform_path, tags))
+            radiomics_csv_to_upload.append((src_filepath, dst_platform_path, tags))
 
     if "Logarithm" in settings["image_filters"]:
-        logarithm_generator = radiomics.imageoperations.getLogarithmImage(anat_img, sitk.GetImageFromArray(mask_img))
-        logarithm_image = next(logarithm_generator)
-
-        src_filepath = os.path.join(output_dir, logarithm_image[1] + "_filtered_image.nii.gz")
-        dst_platform_path = "Logarithm/" + logarithm_image[1] + "_filtered_image.nii.gz"
-        tags = {"logarithm"}
-
-        nib.save(
-            nib.Nifti1Image(sitk.GetArrayFromImage(logarithm_image[0]), mask_nib.affine, mask_nib.header),
-            src_filepath,
-        )
-
-        filtered_images_to_upload.append((src_filepath, dst_platform_path, tags))
-
         dst_platform_path = "Logarithm/logarithm_radiomic_features.csv"
         src_filepath = os.path.join(output_dir, "logarithm_radiomic_features.csv")
         tags = {"logarithm", "csv"}
@@ -210,22 +234,6 @@ def run(context):
         radiomics_csv_to_upload.append((src_filepath, dst_platform_path, tags))
 
     if "Exponential" in settings["image_filters"]:
-        exponential_generator = radiomics.imageoperations.getExponentialImage(
-            anat_img, sitk.GetImageFromArray(mask_img)
-        )
-        exponential_image = next(exponential_generator)
-
-        src_filepath = os.path.join(output_dir, exponential_image[1] + "_filtered_image.nii.gz")
-        dst_platform_path = "Exponential/" + exponential_image[1] + "_filtered_image.nii.gz"
-        tags = {"exponential"}
-
-        nib.save(
-            nib.Nifti1Image(sitk.GetArrayFromImage(exponential_image[0]), mask_nib.affine, mask_nib.header),
-            src_filepath,
-        )
-
-        filtered_images_to_upload.append((src_filepath, dst_platform_path, tags))
-
         dst_platform_path = "Exponential/exponential_radiomic_features.csv"
         src_filepath = os.path.join(output_dir, "exponential_radiomic_features.csv")
         tags = {"exponential", "csv"}
@@ -236,18 +244,24 @@ def run(context):
 
     """ Upload the results """
 
-    # Upload original image, mask and radiomic features extracted from them
+    # Upload original image, mask and radiomic features extracted from them. Outputs with the same content as an
+    # input (or as an output already uploaded) are recorded in the upload manifest instead of transferred again
     context.set_progress(value=90, message="Uploading results")
 
-    context.upload_file(anat, "anatomical_image.nii.gz", modality=modality)
-    context.upload_file(labels, "labels_mask.nii.gz", tags=tags)
-    context.upload_file(original_radiomics_csv, "original_radiomic_features.csv", tags={"csv"})
+    uploader.register_input(anat, "input_anat/" + anat_file.handle.name)
+    uploader.register_input(labels, "input_mask/" + labels_file.handle.name)
+
+    uploader.upload_file(anat, "anatomical_image.nii.gz", modality=anat_file.modality)
+    uploader.upload_file(labels, "labels_mask.nii.gz", tags=labels_file.tags)
+    uploader.upload_file(original_radiomics_csv, "original_radiomic_features.csv", tags={"csv"})
 
     # Upload filtered images and radiomic CSVs
     all_results = filtered_images_to_upload + radiomics_csv_to_upload
     for src_filepath, dst_platform_path, tags in all_results:
-        context.upload_file(
+        uploader.upload_file(
             src_filepath,
             dst_platform_path,
             tags=tags,
         )
+
+    uploader.finish(output_dir)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pywt
+
+
+def supports(kwargs):
+    """Whether the wavelet settings of the extractor can be computed by ``iter_wavelet_bands``."""
+    return kwargs.get("level", 1) == 1 and not kwargs.get("force2D", False)
+
+
+def iter_wavelet_bands(image_array, wavelet="coif1", start_level=0, **kwargs):
+    """
+    Iterate over the sub-bands of the undecimated wavelet decomposition of an image, as they are computed. The
+    sub-bands are those of ``radiomics.imageoperations.getWaveletImage``.
+
+    The separable transform is applied one axis at a time (x, then y, then z), so the 2 first-axis outputs are
+    shared by the 4 second-axis outputs, which are shared by the 8 sub-bands. The tree is walked depth first, so
+    at most two intermediate volumes per axis are alive at once, and a sub-band can be released before the next one
+    is computed.
+
+    Parameters
+    ----------
+    image_array : numpy.ndarray
+        Image to decompose, in SimpleITK (z, y, x) order.
+    wavelet : str
+        Wavelet name, as accepted by ``pywt.Wavelet``.
+    start_level : int
+        Number of approximation levels applied before the decomposition.
+
+    Returns
+    -------
+    iterator of tuple
+        ``(name, array)`` for each sub-band, e.g. ``("wavelet-LLH", array)``, with float32 arrays of the image shape.
+        The approximation (``"wavelet-LLL"``) comes first.
+    """
+    wavelet = pywt.Wavelet(wavelet)
+    original_shape = image_array.shape
+    # The stationary transform needs an even length along each axis
+    padding = [(0, dim % 2) for dim in original_shape]
+    data = np.pad(np.asarray(image_array, dtype=np.float32), padding, "wrap")
+    crop = tuple(slice(0, dim) for dim in original_shape)
+    # The first letter of the sub-band name refers to the last array axis (x), as in pyradiomics
+    axes = tuple(range(data.ndim - 1, -1, -1))
+
+    for _ in range(start_level):
+        for axis in axes:
+            data = _split(data, wavelet, axis)[0]
+
+    for name, band in _decompose(data, wavelet, axes, ""):
+        yield "wavelet-" + name, np.ascontiguousarray(band[crop], dtype=np.float32)
+
+
+def _split(data, wavelet, axis):
+    (low, high), = pywt.swt(data, wavelet, level=1, start_level=0, axis=axis)
+    return low, high
+
+
+def _decompose(data, wavelet, axes, name):
+    if not axes:
+        yield name, data
+        return
+    low, high = _split(data, wavelet, axes[0])
+    yield from _decompose(low, wavelet, axes[1:], name + "L")
+    del low
+    yield from _decompose(high, wavelet, axes[1:], name + "H")
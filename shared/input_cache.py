@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Location of the node-wide cache, shared by every analysis that runs on the same machine. The cache only outlives an
+# analysis if this folder is mounted from the host into the tool container (see the README)
+DEFAULT_CACHE_DIR = os.environ.get(
+    "QMENTA_INPUT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "qmenta_inputs")
+)
+
+FetchedFile = namedtuple("FetchedFile", "handle path modality tags")
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 digest of a file, reading it in chunks so large volumes are never fully loaded.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to hash.
+    chunk_size : int
+        Number of bytes read at a time.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the file contents.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _source_stamp(handle):
+    """Size and modification time of the source of a local file handle, None for platform handles."""
+    container_path = getattr(handle, "_LocalFile__input_container_path", None)
+    if container_path is None:
+        return None
+    try:
+        stat = os.stat(os.path.join(container_path, handle.name))
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def handle_key(input_id, handle):
+    """
+    Build a stable identifier for a platform file handle, used to look it up in the cache before downloading.
+
+    The platform does not expose a checksum before the download, so the key combines everything that identifies
+    the file remotely: the container it lives in, its name and its metadata. A file replaced under the same name
+    must not be served from the stale copy, so the key also includes what changes with the content: the whole
+    metadata record of platform files and the size and modification time of the source of local files.
+
+    Parameters
+    ----------
+    input_id : str
+        Identifier of the input container in the tool settings.
+    handle : qmenta.sdk.context.File
+        File handle returned by ``context.get_files``.
+
+    Returns
+    -------
+    str
+        Hexadecimal key of the handle.
+    """
+    identity = {
+        "input_id": input_id,
+        # Name-mangled attributes of qmenta.sdk.context.File and qmenta.sdk.local.context.LocalFile
+        "container": getattr(handle, "_File__container_id", None)
+        or getattr(handle, "_LocalFile__input_container_path", None),
+        "name": handle.name,
+        "modality": handle.get_file_modality(),
+        "tags": sorted(handle.get_file_tags() or []),
+        "info": handle.get_file_info(),
+        "metadata": getattr(handle, "_File__metadata", None),
+        "source": _source_stamp(handle),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class InputCache:
+    """
+    Content-addressed store of downloaded input files.
+
+    Files are stored once under ``objects/<sha256>`` and ``index.json`` maps file handle keys to those digests, so
+    the same subject fetched by several analyses on the same node is only downloaded the first time. Objects are
+    made read-only and hard-linked into the analysis input folder whenever the filesystem allows it.
+
+    Updates of the index are serialised with a lock file, so analyses running at the same time on the node do not
+    drop each other's entries. Objects are never evicted: the size of the cache is only bounded by its filesystem.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root folder of the cache. It is created if it does not exist.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = os.path.join(cache_dir, "index.lock")
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def lookup(self, key):
+        """Return the path of the cached object for ``key``, or None if it is not (or no longer) in the cache."""
+        digest = self._read_index().get(key)
+        if digest is not None and os.path.isfile(self._object_path(digest)):
+            return self._object_path(digest)
+        return None
+
+    def store(self, key, path):
+        """
+        Move a freshly downloaded file into the cache and record it under ``key``.
+
+        Parameters
+        ----------
+        key : str
+            Handle key, as returned by ``handle_key``.
+        path : str
+            Downloaded file. It is moved, not copied, into the cache.
+
+        Returns
+        -------
+        str
+            Path of the cached object.
+        """
+        digest = file_digest(path)
+        object_path = self._object_path(digest)
+        if os.path.isfile(object_path):
+            os.remove(path)  # Same content already cached under another key
+        else:
+            os.chmod(path, 0o444)
+            os.replace(path, object_path)
+
+        # Several threads (and analyses) may update the index at the same time: re-read it under the locks and
+        # replace it atomically so a reader never sees a partially written file
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = self._read_index()
+            index[key] = digest
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".json")
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        return object_path
+
+    @staticmethod
+    def materialise(object_path, dest_path):
+        """Place a cached object at ``dest_path``, hard-linking it when possible and copying it otherwise."""
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(object_path, dest_path)
+        except OSError:
+            shutil.copyfile(object_path, dest_path)
+        return dest_path
+
+    def fetch(self, input_id, handle, dest_dir):
+        """
+        Make the file behind ``handle`` available in ``dest_dir``, downloading it only on a cache miss.
+
+        Parameters
+        ----------
+        input_id : str
+            Identifier of the input container the handle belongs to.
+        handle : qmenta.sdk.context.File
+            File handle returned by ``context.get_files``.
+        dest_dir : str
+            Folder where the file should be placed.
+
+        Returns
+        -------
+        str
+            Path of the file inside ``dest_dir``.
+        """
+        logger = logging.getLogger(__name__)
+        if handle.name.endswith(".zip"):
+            # Packed inputs are unpacked into folders, which are not content-addressable as a single object
+            return handle.download(dest_dir)
+
+        key = handle_key(input_id, handle)
+        dest_path = os.path.join(dest_dir, handle.name)
+        object_path = self.lookup(key)
+        if object_path is not None:
+            logger.info("Input cache hit for {!r}".format(handle.name))
+            return self.materialise(object_path, dest_path)
+
+        logger.info("Input cache miss for {!r}, downloading".format(handle.name))
+        staging_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        try:
+            object_path = self.store(key, handle.download(staging_dir))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        return self.materialise(object_path, dest_path)
+
+
+def fetch_inputs(context, conditions, dest_dir, cache=None, max_workers=4):
+    """
+    Resolve the file handles of several input containers once and download all of them concurrently.
+
+    Parameters
+    ----------
+    context : qmenta.sdk.context.AnalysisContext
+        Analysis context object to communicate with the QMENTA Platform.
+    conditions : list of tuple
+        ``(input_id, file_filter_condition_name)`` pairs to fetch.
+    dest_dir : str
+        Folder where the input files are placed.
+    cache : InputCache, optional
+        Cache used to avoid downloading files already present on this node. A cache at ``DEFAULT_CACHE_DIR`` is
+        used if not given.
+    max_workers : int
+        Maximum number of simultaneous downloads.
+
+    Returns
+    -------
+    dict
+        Maps each ``(input_id, file_filter_condition_name)`` pair to a list of ``FetchedFile``.
+    """
+    cache = cache or InputCache()
+
+    # Resolve every handle (and its metadata) a single time
+    handles = {}
+    for input_id, condition in conditions:
+        handles[input_id, condition] = context.get_files(input_id, file_filter_condition_name=condition)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            (input_id, condition): [pool.submit(cache.fetch, input_id, fh, dest_dir) for fh in file_handles]
+            for (input_id, condition), file_handles in handles.items()
+        }
+        fetched = {}
+        for (input_id, condition), file_futures in futures.items():
+            fetched[input_id, condition] = [
+                FetchedFile(fh, future.result(), fh.get_file_modality(), fh.get_file_tags())
+                for fh, future in zip(handles[input_id, condition], file_futures)
+            ]
+    return fetched
+
+
+class _CachedFile(object):
+    """File handle whose ``download`` is replaced, every other attribute is the one of the wrapped handle."""
+
+    def __init__(self, handle, download):
+        self._handle = handle
+        self.download = download
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+
+class CachedDownloads(object):
+    """
+    Route the downloads of the file handles returned by ``context.get_files`` through the input cache, concurrently.
+
+    Used as a context manager around code that downloads the handles itself, such as ``Tool.prepare_inputs`` of the
+    tool maker, so that code keeps deciding where every file goes. Inside the block ``download`` returns the path the
+    file will have as soon as the download is scheduled; all downloads are complete when the block exits.
+
+    Parameters
+    ----------
+    context : qmenta.sdk.context.AnalysisContext
+        Analysis context object to communicate with the QMENTA Platform.
+    cache : InputCache, optional
+        Cache used to avoid downloading files already present on this node. A cache at ``DEFAULT_CACHE_DIR`` is
+        used if not given.
+    max_workers : int
+        Maximum number of simultaneous downloads.
+
+    Attributes
+    ----------
+    errors : dict
+        Maps the identifier of each input container with a failed download to the first exception raised, once the
+        block exits.
+    """
+
+    def __init__(self, context, cache=None, max_workers=4):
+        self.context = context
+        self.cache = cache or InputCache()
+        self.max_workers = max_workers
+        self.errors = {}
+        self._pool = None
+        self._downloads = []  # List[(input_id : str, future)]
+
+    def __enter__(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._get_files = self.context.get_files
+        # The instance attribute shadows the method of the context until the block exits
+        self.context.get_files = self._cached_get_files
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.context.get_files
+        self._pool.shutdown(wait=True)
+        for input_id, future in self._downloads:
+            if future.exception() is not None:
+                self.errors.setdefault(input_id, future.exception())
+        return False
+
+    def _cached_get_files(self, input_id, *args, **kwargs):
+        return [
+            _CachedFile(handle, lambda dest_path, handle=handle: self._download(input_id, handle, dest_path))
+            for handle in self._get_files(input_id, *args, **kwargs)
+        ]
+
+    def _download(self, input_id, handle, dest_path):
+        # Same path as handle.download: the folder of an unpacked .zip, or the file inside dest_path otherwise
+        dest_path = os.path.abspath(dest_path)
+        self._downloads.append((input_id, self._pool.submit(self.cache.fetch, input_id, handle, dest_path)))
+        return dest_path if handle.name.endswith(".zip") else os.path.join(dest_path, handle.name)
@@ -0,0 +1,126 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from input_cache import CachedDownloads, InputCache, fetch_inputs
+
+
+class FakeFile:
+    """Minimal stand-in for qmenta.sdk.local.context.LocalFile that counts its downloads."""
+
+    def __init__(self, source):
+        self.name = os.path.basename(source)
+        self.source = source
+        self._LocalFile__input_container_path = os.path.dirname(source)
+        self.downloads = 0
+
+    def get_file_modality(self):
+        return "T1"
+
+    def get_file_tags(self):
+        return {"mask"}
+
+    def get_file_info(self):
+        return {}
+
+    def download(self, dest_path):
+        self.downloads += 1
+        os.makedirs(dest_path, exist_ok=True)
+        shutil.copyfile(self.source, os.path.join(dest_path, self.name))
+        return os.path.join(dest_path, self.name)
+
+
+class FakeContext:
+    def __init__(self, files):
+        self.files = files
+        self.get_files_calls = 0
+
+    def get_files(self, input_id, file_filter_condition_name=None):
+        self.get_files_calls += 1
+        return [self.files[input_id]]
+
+
+class TestInputCache(unittest.TestCase):
+    """Tests for the concurrent, content-addressed input fetch layer.
+    $ pytest shared/test/test_input_cache.py
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache = InputCache(os.path.join(self.tmp_dir, "cache"))
+
+    def make_file(self, name, content):
+        path = os.path.join(self.tmp_dir, "platform", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        return FakeFile(path)
+
+    def test_second_run_is_served_from_cache(self):
+        """Fetching the same subject twice only downloads it once"""
+        anat = self.make_file("anat.nii.gz", b"anat")
+        mask = self.make_file("mask.nii.gz", b"mask")
+        context = FakeContext({"input_anat": anat, "input_mask": mask})
+        conditions = [("input_anat", "c_anat"), ("input_mask", "c_labels")]
+
+        for run in ("run1", "run2"):
+            fetched = fetch_inputs(context, conditions, os.path.join(self.tmp_dir, run), cache=self.cache)
+            with open(fetched["input_anat", "c_anat"][0].path, "rb") as f:
+                self.assertEqual(f.read(), b"anat")
+            self.assertEqual(fetched["input_mask", "c_labels"][0].tags, {"mask"})
+
+        self.assertEqual((anat.downloads, mask.downloads), (1, 1))
+        self.assertEqual(context.get_files_calls, 4)  # once per condition and run
+
+    def test_changed_content_is_downloaded_again(self):
+        """A file rewritten under the same name is not served from the stale cached copy"""
+        anat = self.make_file("anat.nii.gz", b"version 1")
+        context = FakeContext({"input_anat": anat})
+        conditions = [("input_anat", "c_anat")]
+        fetch_inputs(context, conditions, os.path.join(self.tmp_dir, "run1"), cache=self.cache)
+
+        with open(anat.source, "wb") as f:
+            f.write(b"version 2 corrected")
+        fetched = fetch_inputs(context, conditions, os.path.join(self.tmp_dir, "run2"), cache=self.cache)
+
+        with open(fetched["input_anat", "c_anat"][0].path, "rb") as f:
+            self.assertEqual(f.read(), b"version 2 corrected")
+        self.assertEqual(anat.downloads, 2)
+
+    def test_identical_content_is_stored_once(self):
+        """Two different handles with the same bytes share a single cached object"""
+        first = self.make_file("first.nii.gz", b"same")
+        second = self.make_file("second.nii.gz", b"same")
+        self.cache.fetch("input", first, os.path.join(self.tmp_dir, "out"))
+        self.cache.fetch("input", second, os.path.join(self.tmp_dir, "out"))
+        self.assertEqual(len(os.listdir(self.cache.objects_dir)), 1)
+
+    def test_cached_downloads_keep_the_destination_of_the_caller(self):
+        """Handles downloaded inside the block land where the caller asked, and are only downloaded once"""
+        anat = self.make_file("anat.nii.gz", b"anat")
+        context = FakeContext({"input_anat": anat})
+
+        for run in ("run1", "run2"):
+            dest_dir = os.path.join(self.tmp_dir, run, "input_anat")
+            with CachedDownloads(context, cache=self.cache) as downloads:
+                handle = context.get_files("input_anat", file_filter_condition_name="c_anat")[0]
+                path = handle.download(dest_dir)
+                self.assertEqual(handle.get_file_tags(), {"mask"})
+            self.assertEqual(path, os.path.join(dest_dir, "anat.nii.gz"))
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"anat")
+            self.assertEqual(downloads.errors, {})
+
+        self.assertEqual(anat.downloads, 1)
+        self.assertNotIn("get_files", vars(context))
+
+    def test_cached_downloads_report_errors_per_input(self):
+        missing = FakeFile(os.path.join(self.tmp_dir, "platform", "missing.nii.gz"))
+        context = FakeContext({"input_mask": missing})
+        with CachedDownloads(context, cache=self.cache) as downloads:
+            context.get_files("input_mask")[0].download(os.path.join(self.tmp_dir, "out"))
+        self.assertIsInstance(downloads.errors["input_mask"], IOError)
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from upload_manager import UploadManager
+
+
+class FakeContext:
+    def __init__(self):
+        self.uploaded = []
+
+    def upload_file(self, source_file_path, destination_path, **kwargs):
+        self.uploaded.append(destination_path)
+
+
+class TestUploadManager(unittest.TestCase):
+    """Tests for the deduplicating upload manager.
+    $ pytest shared/test/test_upload_manager.py
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def make_file(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_duplicates_are_recorded_as_references(self):
+        """Echoed inputs and repeated outputs are not transferred, and the saved bytes are reported"""
+        anat = self.make_file("anat.nii.gz", b"0123456789")
+        features = self.make_file("features.csv", b"a,b")
+        features_copy = self.make_file("features_copy.csv", b"a,b")
+
+        context = FakeContext()
+        uploader = UploadManager(context)
+        uploader.register_input(anat, "input_anat/anat.nii.gz")
+
+        self.assertFalse(uploader.upload_file(anat, "anatomical_image.nii.gz"))
+        self.assertTrue(uploader.upload_file(features, "features.csv", tags={"csv"}))
+        self.assertFalse(uploader.upload_file(features_copy, "Wavelet/features.csv"))
+        manifest_path = uploader.finish(self.tmp_dir)
+
+        self.assertEqual(context.uploaded, ["features.csv", "upload_manifest.json"])
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["bytes_saved"], 13)
+        self.assertEqual(manifest["bytes_uploaded"], 3)
+        self.assertEqual(manifest["files"]["anatomical_image.nii.gz"]["reference"], "input_anat/anat.nii.gz")
+        self.assertEqual(manifest["files"]["Wavelet/features.csv"]["reference"], "features.csv")
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+
+from input_cache import file_digest
+
+
+class UploadManager:
+    """
+    Upload results to the platform, transferring each distinct content only once.
+
+    Every output is hashed before it is uploaded. If the same bytes were already uploaded in this analysis, or are
+    one of the analysis inputs registered with ``register_input``, the output is recorded in the upload manifest as
+    a reference to the existing platform file instead of being transferred again.
+
+    Parameters
+    ----------
+    context : qmenta.sdk.context.AnalysisContext
+        Analysis context object to communicate with the QMENTA Platform.
+    manifest_name : str
+        Platform path of the manifest uploaded by ``finish``.
+    """
+
+    def __init__(self, context, manifest_name="upload_manifest.json"):
+        self.context = context
+        self.manifest_name = manifest_name
+        self.entries = {}  # Dict[dst_platform_path : str, Dict]
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+        self._locations = {}  # Dict[sha256 : str, platform_path : str]
+
+    def register_input(self, path, platform_path):
+        """
+        Record a file that already exists in the platform, so outputs with the same content become references.
+
+        Parameters
+        ----------
+        path : str
+            Local copy of the file.
+        platform_path : str
+            Location of the file in the platform, e.g. ``input_anat/image.nii.gz``.
+        """
+        self._locations.setdefault(file_digest(path), platform_path)
+
+    def upload_file(self, source_file_path, destination_path, **kwargs):
+        """
+        Upload a file unless byte-identical content is already in the platform. Accepts the same arguments as
+        ``context.upload_file``.
+
+        Returns
+        -------
+        bool
+            True if the file was transferred, False if it was recorded as a reference.
+        """
+        digest = file_digest(source_file_path)
+        size = os.path.getsize(source_file_path)
+        entry = {"sha256": digest, "size": size}
+        self.entries[destination_path] = entry
+
+        reference = self._locations.get(digest)
+        if reference is not None:
+            logging.getLogger(__name__).info(
+                "Skipping upload of {!r}, same content as {!r}".format(destination_path, reference)
+            )
+            entry["reference"] = reference
+            self.bytes_saved += size
+            return False
+
+        self.context.upload_file(source_file_path, destination_path, **kwargs)
+        self._locations[digest] = destination_path
+        self.bytes_uploaded += size
+        return True
+
+    def finish(self, output_dir):
+        """
+        Write the upload manifest, upload it and report the bytes saved by the deduplication.
+
+        Parameters
+        ----------
+        output_dir : str
+            Local folder where the manifest is written.
+
+        Returns
+        -------
+        str
+            Local path of the manifest.
+        """
+        manifest_path = os.path.join(output_dir, self.manifest_name)
+        with open(manifest_path, "w") as f:
+            json.dump(
+                {"files": self.entries, "bytes_uploaded": self.bytes_uploaded, "bytes_saved": self.bytes_saved},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        self.context.upload_file(manifest_path, self.manifest_name, tags={"manifest"})
+
+        references = sum("reference" in entry for entry in self.entries.values())
+        logging.getLogger(__name__).info(
+            "Uploaded {} bytes, saved {} bytes by referencing {} duplicate file(s)".format(
+                self.bytes_uploaded, self.bytes_saved, references
+            )
+        )
+        return manifest_path